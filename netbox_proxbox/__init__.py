@@ -33,7 +33,9 @@ class ProxboxConfig(PluginConfig):
             'settings': {
                 'virtualmachine_role_id': 0,
                 'node_role_id': 0,
-                'site_id': 0
+                'site_id': 0,
+                'db_max_concurrency': 10,
+                'full_sync_interval': 60
             },
             'manufacturer': 'Dell',
             'virtualmachine_role_id': 0,
@@ -4,8 +4,10 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 import asyncio
 
+from netbox_proxbox.proxbox_api_v2.scanner.vm_port_scanner_async import VMPortScannerAsync
 from netbox_proxbox.proxbox_api_v2.scanner.vm_port_scanner_queue import VMPortScannerQueue
 from netbox_proxbox.proxbox_api_v2.scanner.vm_port_scanner_sync import VMPortScannerSync
+from netbox_proxbox.proxbox_api_v2.logs import configure_from_verbosity, stop_logging
 
 
 class Command(BaseCommand):
@@ -13,12 +15,41 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('tenants', nargs='+', help="Tenants for the machines to get the ports")
-        pass
+        parser.add_argument('--engine', choices=['async', 'queue'], default='async',
+                            help="async scans from a single event loop, queue uses a thread per socket")
+        parser.add_argument('--max-in-flight', type=int, default=2000,
+                            help="Connections open at the same time by the async engine")
+        parser.add_argument('--per-host-limit', type=int, default=200,
+                            help="Connections open at the same time to a single ip by the async engine")
+        parser.add_argument('--per-host-rate', type=float, default=None,
+                            help="New connections per second to a single ip by the async engine")
+        parser.add_argument('--timeout', type=float, default=3,
+                            help="Maximum connect timeout, the async engine uses it until the ip answered")
+        parser.add_argument('--min-timeout', type=float, default=0.2,
+                            help="Minimum connect timeout of the async engine")
+        parser.add_argument('--retries', type=int, default=1,
+                            help="Retries of the ports without answer in the async engine")
 
     def handle(self, *args, **options):
         tenants = options.get('tenants')
-        scanner = VMPortScannerQueue(tenants=tenants)
-        scanner.run()
+        # -v 0 only errors, -v 1 the summary of the scan, -v 2 every open port
+        configure_from_verbosity(options['verbosity'])
+        try:
+            if options.get('engine') == 'queue':
+                scanner = VMPortScannerQueue(tenants=tenants)
+            else:
+                scanner = VMPortScannerAsync(
+                    tenants=tenants,
+                    max_in_flight=options.get('max_in_flight'),
+                    per_host_limit=options.get('per_host_limit'),
+                    per_host_rate=options.get('per_host_rate'),
+                    timeout=options.get('timeout'),
+                    min_timeout=options.get('min_timeout'),
+                    retries=options.get('retries')
+                )
+            scanner.run()
+        finally:
+            stop_logging()
         # VMPortScannerSync.run(tenants)
         # asyncio.run(VMPortScanner.async_run(tenants))
         # Scrapper.run()
@@ -6,6 +6,9 @@ import asyncio
 
 
 from netbox_proxbox.proxbox_api_v2.scrapper import Scrapper
+from netbox_proxbox.proxbox_api_v2.selection import SyncSelection
+from netbox_proxbox.proxbox_api_v2 import metrics
+from netbox_proxbox.proxbox_api_v2.logs import configure_from_verbosity, stop_logging
 
 
 class Command(BaseCommand):
@@ -13,10 +16,60 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         # parser.add_argument('reports', nargs='+', help="Report(s) to run")
-        pass
+        parser.add_argument(
+            '--incremental', action='store_true', default=False,
+            help="Only sync the vms changed in Proxmox since the previous job, with a full sync every "
+                 "netbox.settings.full_sync_interval minutes"
+        )
+        parser.add_argument(
+            '--resume', metavar='JOB_ID', default=None,
+            help="Resume an interrupted job, skipping the domains it finished and the vms it already wrote. The job "
+                 "keeps its own --incremental and selection options"
+        )
+        parser.add_argument(
+            '--domain', action='append', dest='domains', metavar='DOMAIN',
+            help="Only sync this domain of the configuration file, can be repeated"
+        )
+        parser.add_argument(
+            '--cluster', action='append', dest='clusters', metavar='CLUSTER',
+            help="Only sync the domains of this Proxmox cluster, can be repeated"
+        )
+        parser.add_argument(
+            '--node', action='append', dest='nodes', metavar='NODE',
+            help="Only sync the vms of this Proxmox node, can be repeated"
+        )
+        parser.add_argument(
+            '--vmid', action='append', dest='vmids', type=int, metavar='VMID',
+            help="Only sync this vm, can be repeated"
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help="Split the domains between this many processes, every process cleans the domains it synced"
+        )
+        parser.add_argument(
+            '--metrics-file', default=None,
+            help="Write the Prometheus metrics of the job to this file for the node exporter textfile collector "
+                 "(needs prometheus_client)"
+        )
+        parser.add_argument(
+            '--metrics-port', type=int, default=None,
+            help="Serve the Prometheus metrics on this port while the job runs (needs prometheus_client)"
+        )
 
     def handle(self, *args, **options):
-        asyncio.run(Scrapper.async_run())
+        # -v 0 only errors, -v 1 the summary of the job, -v 2 every vm
+        configure_from_verbosity(options['verbosity'])
+        try:
+            if options['metrics_port']:
+                metrics.start_server(options['metrics_port'])
+            selection = SyncSelection.from_options(options['domains'], options['clusters'], options['nodes'],
+                                                   options['vmids'])
+            asyncio.run(Scrapper.async_run(incremental=options['incremental'], resume=options['resume'],
+                                           workers=options['workers'], selection=selection))
+            if options['metrics_file']:
+                metrics.write_textfile(options['metrics_file'])
+        finally:
+            stop_logging()
         # Scrapper.run()
         # Wrap things up
         self.stdout.write(
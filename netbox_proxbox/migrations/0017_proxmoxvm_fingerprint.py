@@ -0,0 +1,18 @@
+# Generated by Django 3.2.12 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_proxbox', '0016_auto_20220726_2003'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proxmoxvm',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Proxmox data fingerprint'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.12 on 2026-10-18 10:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('netbox_proxbox', '0017_proxmoxvm_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='proxmoxvm',
+            index=models.Index(fields=['domain', 'latest_job'], name='proxmoxvm_domain_job_idx'),
+        ),
+    ]
@@ -157,9 +157,22 @@ class ProxmoxVM(ChangeLoggedModel):
         verbose_name="Proxmox configuration"
     )
 
+    fingerprint = models.CharField(
+        max_length=64,
+        blank=True,
+        null=True,
+        verbose_name="Proxmox data fingerprint"
+    )
+
     # Retrieve and filter 'ProxmoxVM' records
     objects = RestrictedQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            # Used to find the vms that were not seen by a job
+            models.Index(fields=['domain', 'latest_job'], name='proxmoxvm_domain_job_idx'),
+        ]
+
     # display name of ProxmoxVM object defined to virtual_machine
     def __str__(self):
         if self.virtual_machine:
@@ -0,0 +1,41 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .plugins_config import PROXMOX_SESSIONS_LIST, NETBOX_DB_MAX_CONCURRENCY
+
+# Semaphores are bound to the event loop running the job
+_semaphores = {}
+
+
+def _get_semaphore(key, size):
+    loop_key = (id(asyncio.get_running_loop()), key)
+    semaphore = _semaphores.get(loop_key)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, int(size)))
+        _semaphores[loop_key] = semaphore
+    return semaphore
+
+
+def get_domain_semaphore(proxbox_session):
+    """
+    Limits the calls made at the same time against a Proxmox domain
+    """
+    return _get_semaphore(('proxmox', proxbox_session.domain), proxbox_session.max_concurrency)
+
+
+def get_netbox_db_semaphore():
+    """
+    Limits the work done at the same time against the NetBox database, it should not be bigger than the
+    connection pool of the database
+    """
+    return _get_semaphore(('netbox',), NETBOX_DB_MAX_CONCURRENCY)
+
+
+def configure_default_executor():
+    """
+    Size the thread pool used by asyncio.to_thread so it never caps the configured concurrency
+    """
+    workers = NETBOX_DB_MAX_CONCURRENCY + sum(max(1, int(s.max_concurrency)) for s in PROXMOX_SESSIONS_LIST)
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max(32, workers)))
+    return workers
@@ -0,0 +1,103 @@
+'''
+Logging of the scrapper and the port scanner.
+
+Every module logs with logging.getLogger(__name__), all of them under the netbox_proxbox logger. configure_logging
+attaches a QueueHandler to it, the records are written to stdout by a QueueListener thread, so the workers never
+block on stdout. The per object messages are logged at debug level, by default only the per job summaries and the
+errors are written.
+
+The same message can only be written burst times every interval seconds, the rest are counted and reported with
+the next message written.
+'''
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+ROOT_LOGGER_NAME = 'netbox_proxbox'
+LOG_FORMAT = '[%(asctime)s] %(levelname)s %(name)s: %(message)s'
+LOG_DATE_FORMAT = '%H:%M:%S'
+
+# Django verbosity (-v) -> level
+VERBOSITY_LEVELS = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG, 3: logging.DEBUG}
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let the same message (same logger and format string) through at most burst times every interval seconds
+    """
+
+    def __init__(self, burst=20, interval=10):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # (logger name, msg) -> [window start, count in window, suppressed]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window is not None else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = '{} ({} similar messages suppressed)'.format(record.msg, suppressed)
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def configure_logging(level=logging.INFO, burst=20, interval=10):
+    """
+    Attach the non blocking handler to the netbox_proxbox logger, calling it again only changes the level
+    """
+    global _listener
+    logger = logging.getLogger(ROOT_LOGGER_NAME)
+    logger.setLevel(level)
+    if _listener is not None:
+        return logger
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(burst, interval))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    return logger
+
+
+def configure_from_verbosity(verbosity):
+    return configure_logging(VERBOSITY_LEVELS.get(verbosity, logging.DEBUG))
+
+
+def stop_logging():
+    """
+    Write the records still in the queue, call it before the process exits
+    """
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+    logger = logging.getLogger(ROOT_LOGGER_NAME)
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+    logger.propagate = True
@@ -0,0 +1,150 @@
+'''
+Prometheus metrics of the scrapper, they need the optional prometheus_client dependency, without it every helper
+is a no-op.
+
+The metrics live in their own registry and are written at the end of every job to a file for the textfile
+collector of the node exporter (proxboxscrapper --metrics-file), or served while the job runs
+(proxboxscrapper --metrics-port).
+
+    proxbox_proxmox_request_seconds{domain, endpoint}   latency of the Proxmox API calls
+    proxbox_netbox_vm_queries{domain}                   database queries of every vm upsert
+    proxbox_netbox_vm_query_seconds{domain}             time spent in the database by every vm upsert
+    proxbox_stage_seconds{stage, domain}                duration of the cluster, nodes, vms and cleanup stages
+    proxbox_objects_total{domain, action}               created, updated, unchanged and deleted vms
+    proxbox_job_last_success_timestamp_seconds          end of the latest job
+'''
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+try:
+    from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server, \
+        write_to_textfile
+except ImportError:
+    CollectorRegistry = None
+
+try:
+    from django.db import connection
+except Exception as e:
+    logger.exception(e)
+    raise e
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+REGISTRY = None
+PROXMOX_REQUEST_SECONDS = None
+NETBOX_VM_QUERIES = None
+NETBOX_VM_QUERY_SECONDS = None
+STAGE_SECONDS = None
+OBJECTS_TOTAL = None
+JOB_LAST_SUCCESS = None
+
+if CollectorRegistry is not None:
+    REGISTRY = CollectorRegistry()
+    PROXMOX_REQUEST_SECONDS = Histogram(
+        'proxbox_proxmox_request_seconds', 'Latency of the Proxmox API requests',
+        ['domain', 'endpoint'], buckets=LATENCY_BUCKETS, registry=REGISTRY)
+    NETBOX_VM_QUERIES = Histogram(
+        'proxbox_netbox_vm_queries', 'NetBox database queries per vm upsert',
+        ['domain'], buckets=QUERY_BUCKETS, registry=REGISTRY)
+    NETBOX_VM_QUERY_SECONDS = Histogram(
+        'proxbox_netbox_vm_query_seconds', 'Time spent in the NetBox database per vm upsert',
+        ['domain'], buckets=LATENCY_BUCKETS, registry=REGISTRY)
+    STAGE_SECONDS = Histogram(
+        'proxbox_stage_seconds', 'Duration of the stages of the scrapper',
+        ['stage', 'domain'], buckets=STAGE_BUCKETS, registry=REGISTRY)
+    OBJECTS_TOTAL = Counter(
+        'proxbox_objects_total', 'Vms created, updated, unchanged and deleted by the scrapper',
+        ['domain', 'action'], registry=REGISTRY)
+    JOB_LAST_SUCCESS = Gauge(
+        'proxbox_job_last_success_timestamp_seconds', 'End of the latest scrapper job',
+        registry=REGISTRY)
+
+
+def is_enabled():
+    return REGISTRY is not None
+
+
+@contextmanager
+def time_proxmox_request(domain, endpoint):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if PROXMOX_REQUEST_SECONDS is not None:
+            PROXMOX_REQUEST_SECONDS.labels(domain or '', endpoint or 'unknown').observe(time.perf_counter() - start)
+
+
+@contextmanager
+def time_stage(stage, domain=''):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if STAGE_SECONDS is not None:
+            STAGE_SECONDS.labels(stage, domain or '').observe(time.perf_counter() - start)
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+@contextmanager
+def count_vm_queries(domain):
+    """
+    Count the queries run by the current thread while upserting a vm, the database connection is per thread so
+    only the queries of this vm are seen
+    """
+    if NETBOX_VM_QUERIES is None:
+        yield None
+        return
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        yield counter
+    NETBOX_VM_QUERIES.labels(domain or '').observe(counter.count)
+    NETBOX_VM_QUERY_SECONDS.labels(domain or '').observe(counter.seconds)
+
+
+def count_object(domain, action, amount=1):
+    if OBJECTS_TOTAL is not None and amount:
+        OBJECTS_TOTAL.labels(domain or '', action).inc(amount)
+
+
+def set_job_success():
+    if JOB_LAST_SUCCESS is not None:
+        JOB_LAST_SUCCESS.set_to_current_time()
+
+
+def start_server(port):
+    if not is_enabled():
+        logger.error("Error: the metrics need prometheus_client installed")
+        return False
+    start_http_server(int(port), registry=REGISTRY)
+    return True
+
+
+def write_textfile(path):
+    if not is_enabled():
+        logger.error("Error: the metrics need prometheus_client installed")
+        return False
+    try:
+        write_to_textfile(path, REGISTRY)
+        return True
+    except Exception as e:
+        logger.error("Error: write_textfile - %s", e)
+        return False
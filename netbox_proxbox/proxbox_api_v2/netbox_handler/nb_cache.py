@@ -0,0 +1,64 @@
+'''
+Job scoped cache of the NetBox reference data (tags, tenants, tenant groups, content types, roles, ...) shared by
+the netbox_handler modules, so the same rows are not selected again for every vm.
+
+The values are stored by namespace and key, e.g. ('tag', 'proxbox'). A loader is only run when the value is not
+cached yet, and the functions creating a row store it right away so every thread sees it.
+'''
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from django.contrib.contenttypes.models import ContentType
+except Exception as e:
+    logger.exception(e)
+    raise e
+
+_values = {}
+# Held while loading a missing value, so two threads can't create the same row at the same time
+_lock = threading.RLock()
+
+
+def get_or_load(namespace, key, loader):
+    value = _values.get((namespace, key))
+    if value is not None:
+        return value
+    with _lock:
+        value = _values.get((namespace, key))
+        if value is None:
+            value = loader()
+            if value is not None:
+                _values[(namespace, key)] = value
+    return value
+
+
+def set_value(namespace, key, value):
+    if value is None:
+        invalidate(namespace, key)
+    else:
+        _values[(namespace, key)] = value
+    return value
+
+
+def invalidate(namespace=None, key=None):
+    with _lock:
+        if namespace is None:
+            _values.clear()
+            return
+        for cache_key in list(_values.keys()):
+            if cache_key[0] == namespace and (key is None or cache_key[1] == key):
+                _values.pop(cache_key, None)
+
+
+def clear():
+    invalidate()
+
+
+def get_content_type(app_label, model):
+    return get_or_load(
+        'content_type', (app_label, model),
+        lambda: ContentType.objects.filter(app_label=app_label, model=model).first()
+    )
@@ -0,0 +1,107 @@
+'''
+Parser of the metadata written by hand in the description of the vms (client, tenant, contact email, main ip and
+ip allocation) and of the ip addresses of the network configuration (net0/ipconfig0).
+
+The patterns are compiled once and every description is parsed once into a VMDescription, memoized by its text,
+so the tenant, contact and ip code paths of the same vm share the same result.
+'''
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+from ..plugins_config import NETBOX_TENANT_REGEX_VALIDATOR
+
+IPV4_PATTERN = r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(?:/\d{1,3})?"
+# Every repetition has to start with ':', so the pattern can't backtrack over the same characters
+IPV6_PATTERN = r"[a-z0-9]{1,4}(?::[a-z0-9]{0,4}){2,15}(?:\.\d{1,3}\.\d{1,3}\.\d{1,3})?(?:/\d{1,3})?"
+
+NETWORK_IPV4_RE = re.compile(r"ip=(" + IPV4_PATTERN + ")")
+NETWORK_IPV6_RE = re.compile(r"ip6=(" + IPV6_PATTERN + ")", re.IGNORECASE)
+
+MAIN_IP_LABEL = r"main\s?ip:\s?"
+ALLOCATION_LABEL = r"ip\s?address\s?allocation:\s?"
+MAIN_IPV4_RE = re.compile(MAIN_IP_LABEL + "(" + IPV4_PATTERN + ")", re.IGNORECASE)
+MAIN_IPV6_RE = re.compile(MAIN_IP_LABEL + "(" + IPV6_PATTERN + ")", re.IGNORECASE)
+ALLOCATION_IPV4_RE = re.compile(ALLOCATION_LABEL + "(" + IPV4_PATTERN + ")", re.IGNORECASE)
+ALLOCATION_IPV6_RE = re.compile(ALLOCATION_LABEL + "(" + IPV6_PATTERN + ")", re.IGNORECASE)
+
+EMAIL_RE = re.compile(r"email\s?:?\s?(\w+(?:[.-]\w+)*@\w+(?:[.-]\w+)*\.\w{2,3})", re.IGNORECASE)
+
+CLIENT_RE = re.compile(r"client\s?:?.*(?:id)?:", re.IGNORECASE)
+CLIENT_LABELS = ('client:', 'client :', 'Client:', 'Client :', 'id:', 'id :', '(id :', '(ID:', 'Id:', 'Id :',
+                 '(Id :', '(ID :')
+PARENTHESIS_RE = re.compile(r"\(.*\)")
+
+try:
+    TENANT_VALIDATOR_RE = re.compile(NETBOX_TENANT_REGEX_VALIDATOR, re.IGNORECASE)
+except Exception:
+    TENANT_VALIDATOR_RE = None
+
+
+@dataclass(frozen=True)
+class VMDescription:
+    client: str = None
+    tenant_name: str = None
+    contact_email: str = None
+    main_ipv4: str = None
+    main_ipv6: str = None
+
+
+def _search(pattern, value):
+    match = pattern.search(value)
+    return match.group(1).strip() if match else None
+
+
+def _parse_client(description):
+    match = CLIENT_RE.search(description)
+    if match is None:
+        return None, None
+    client = match.group()
+    for label in CLIENT_LABELS:
+        client = client.replace(label, '')
+    client = client.strip()
+
+    tenant_name = None
+    parenthesis = PARENTHESIS_RE.search(client)
+    if parenthesis:
+        m_result = parenthesis.group().strip()
+        if m_result.replace('(', '').replace(')', '').strip():
+            tenant_name = m_result.replace('(', '').replace(')', '').strip()
+        client = client.replace(m_result, '').strip()
+    else:
+        tenant_name = client
+    return tenant_name, client
+
+
+@lru_cache(maxsize=4096)
+def parse_description(description):
+    if not isinstance(description, str) or not description:
+        return VMDescription()
+
+    tenant_name, client = _parse_client(description)
+    main_ipv4 = _search(MAIN_IPV4_RE, description) or _search(ALLOCATION_IPV4_RE, description)
+    main_ipv6 = _search(MAIN_IPV6_RE, description) or _search(ALLOCATION_IPV6_RE, description)
+    return VMDescription(
+        client=client,
+        tenant_name=tenant_name,
+        contact_email=_search(EMAIL_RE, description),
+        main_ipv4=main_ipv4.lower() if main_ipv4 else None,
+        main_ipv6=main_ipv6.lower() if main_ipv6 else None,
+    )
+
+
+@lru_cache(maxsize=4096)
+def parse_network(network_str):
+    """
+    (ipv4, ipv6) of a net0/ipconfig0 value, e.g. name=eth0,bridge=vmbr502,ip=172.16.17.203/24,ip6=fc00:16:17::2/64
+    """
+    if not isinstance(network_str, str):
+        return None, None
+    return _search(NETWORK_IPV4_RE, network_str), _search(NETWORK_IPV6_RE, network_str)
+
+
+@lru_cache(maxsize=4096)
+def has_tenant_string(name):
+    if TENANT_VALIDATOR_RE is None or not isinstance(name, str):
+        return False
+    return TENANT_VALIDATOR_RE.search(name) is not None
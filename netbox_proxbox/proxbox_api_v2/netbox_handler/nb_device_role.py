@@ -1,18 +1,33 @@
-# import logging
-import traceback
+import logging
 
-# logging.basicConfig(level=logging.DEBUG)
-# logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 try:
     from django.template.defaultfilters import slugify
     from dcim.models import DeviceRole
+    from . import nb_cache
 except Exception as e:
-    # logger.exception(e)
-    traceback.print_exc()
+    logger.exception(e)
     raise e
 
 
+def upsert_role_by_name(role_name):
+    role = DeviceRole.objects.filter(name=role_name).first()
+    if role is None:
+        try:
+            role = DeviceRole(
+                name=role_name,
+                slug=slugify(role_name),
+                color='ff5722',
+                vm_role=True
+            )
+            role.save()
+        except Exception as e:
+            logger.error("Error: upsert_role_by_name - %s %s", role_name, e)
+            role = None
+    return role
+
+
 def upsert_role(**kwargs):
     """
     TODO: Improve this function! make it so only calls the device role creation once
@@ -22,21 +37,7 @@ def upsert_role(**kwargs):
     role_id = kwargs.get("role_id", 0)
     role_name = kwargs.get('role_name', None)
     if role_name:
-        role = DeviceRole.objects.filter(name=role_name).first()
-        if role is None:
-            try:
-                role = DeviceRole(
-                    name=role_name,
-                    slug=slugify(role_name),
-                    color='ff5722',
-                    vm_role=True
-                )
-                role.save()
-            except Exception as e:
-                # logger.exception(e)
-                # traceback.print_exc()
-                print(e)
-                role = None
+        role = nb_cache.get_or_load('role', role_name, lambda: upsert_role_by_name(role_name))
         if role:
             return role
 
@@ -77,9 +78,7 @@ def upsert_role(**kwargs):
                 )
                 role.save()
             except Exception as e:
-                # logger.exception(e)
-                # traceback.print_exc()
-                print(e)
+                logger.error("Error: upsert_role - %s", e)
                 return "Error creating the '{0}' role. Possible errors: the name '{0}' or slug '{1}' is already used.".format(
                     role_proxbox_name, role_proxbox_slug)
 
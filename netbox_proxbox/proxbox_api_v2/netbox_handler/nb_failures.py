@@ -0,0 +1,33 @@
+'''
+Steps of a vm upsert that failed.
+
+The steps of upsert_netbox_vm (tenant, role, contact, tags, description, ...) log their errors and go on, so one
+failing step doesn't stop the others. They also report them here, upsert_proxbox_item only stores the fingerprint
+of a vm whose steps all succeeded, otherwise the next job would take the fast path and never retry them.
+
+The steps are collected in a context variable, every upsert runs in its own thread (asyncio.to_thread) so the
+vms synced at the same time don't see the failures of each other.
+'''
+import contextvars
+from contextlib import contextmanager
+
+_failed_steps = contextvars.ContextVar('proxbox_failed_steps', default=None)
+
+
+def report_failure(step):
+    failed_steps = _failed_steps.get()
+    if failed_steps is not None:
+        failed_steps.append(step)
+
+
+@contextmanager
+def track_failures():
+    """
+    Collect the steps reported as failed inside the block
+    """
+    failed_steps = []
+    token = _failed_steps.set(failed_steps)
+    try:
+        yield failed_steps
+    finally:
+        _failed_steps.reset(token)
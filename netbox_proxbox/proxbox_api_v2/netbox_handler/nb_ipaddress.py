@@ -0,0 +1,254 @@
+'''
+Batch reconciliation of the ip addresses of the vms.
+
+The upsert path only parses the addresses of every vm and collects them as (netbox_vm, interface, ipv4, ipv6)
+items. Once all the vms of a cluster are upserted the items are applied together: the interfaces, the existing
+ip addresses and the vms already using them as primary ip are read with one query each, and the changes are
+written with bulk_create/bulk_update in a single transaction.
+'''
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from django.db import transaction
+    from django.db.models import Q
+    from django.template.defaultfilters import slugify
+    from virtualization.models import VirtualMachine, VMInterface
+    from ipam.models import IPAddress
+    from dcim.choices import InterfaceTypeChoices
+    from netaddr import IPNetwork
+
+    from .nb_tag import custom_tag, get_tag_ids_by_object, reconcile_tags
+    from . import nb_cache
+    from ...models import ProxmoxVM
+except Exception as e:
+    logger.exception(e)
+    raise e
+
+PRIMARY_IP_FIELDS = {4: 'primary_ip4_id', 6: 'primary_ip6_id'}
+
+
+def normalize_address(address):
+    """
+    Address in the same form NetBox returns it, so the parsed and the stored addresses can be compared as keys
+    """
+    if address is None:
+        return None
+    try:
+        return str(IPNetwork(address))
+    except Exception as e:
+        logger.error("Error: normalize_address - %s %s", address, e)
+        return None
+
+
+def get_interfaces(items):
+    """
+    (vm id, interface name) -> VMInterface, creating the missing interfaces in one insert
+    """
+    vm_ids = {netbox_vm.id for netbox_vm, _, _, _ in items}
+    names = {name for _, name, _, _ in items}
+    interfaces = {}
+    for interface in VMInterface.objects.filter(virtual_machine_id__in=vm_ids, name__in=names):
+        interfaces.setdefault((interface.virtual_machine_id, interface.name), interface)
+
+    new_interfaces = {}
+    for netbox_vm, name, _, _ in items:
+        key = (netbox_vm.id, name)
+        if key in interfaces or key in new_interfaces:
+            continue
+        interface = VMInterface(name=name)
+        interface.description = "LAG"
+        interface.virtual_machine_id = netbox_vm.id
+        interface.type = InterfaceTypeChoices.TYPE_LAG
+        new_interfaces[key] = interface
+    if new_interfaces:
+        VMInterface.objects.bulk_create(list(new_interfaces.values()))
+        interfaces.update(new_interfaces)
+    return interfaces
+
+
+def get_ip_addresses(addresses, interfaces_by_address, content_type):
+    """
+    address -> IPAddress, creating the missing addresses in one insert, assigned to the first interface using them
+    """
+    ip_addresses = {}
+    for netbox_ip in IPAddress.objects.filter(address__in=list(addresses)):
+        ip_addresses.setdefault(str(netbox_ip.address), netbox_ip)
+
+    new_ips = []
+    for address in addresses:
+        if address in ip_addresses:
+            continue
+        interface = interfaces_by_address[address]
+        netbox_ip = IPAddress(address=address)
+        netbox_ip.assigned_object_type_id = content_type.id
+        netbox_ip.assigned_object_id = interface.id
+        ip_addresses[address] = netbox_ip
+        new_ips.append(netbox_ip)
+    if new_ips:
+        IPAddress.objects.bulk_create(new_ips)
+    return ip_addresses
+
+
+def get_primary_ip_owners(ip_ids):
+    """
+    (family, ip id) -> (vm id, vm name) of the vms using the addresses as primary ip
+    """
+    owners = {}
+    if not ip_ids:
+        return owners
+    values = VirtualMachine.objects.filter(
+        Q(primary_ip4_id__in=ip_ids) | Q(primary_ip6_id__in=ip_ids)
+    ).values_list('id', 'name', 'primary_ip4_id', 'primary_ip6_id')
+    for vm_id, name, primary_ip4_id, primary_ip6_id in values:
+        if primary_ip4_id in ip_ids:
+            owners.setdefault((4, primary_ip4_id), (vm_id, name))
+        if primary_ip6_id in ip_ids:
+            owners.setdefault((6, primary_ip6_id), (vm_id, name))
+    return owners
+
+
+def repeated_ip_tag():
+    name = 'Repeated Ip'
+    tag_description = "No description"
+    color = 'ff3c3f'
+    return custom_tag(name, slugify(name), tag_description, color)
+
+
+def tag_duplicated_ips(duplicates, repeated_tag):
+    """
+    Tag the vms whose address is already the primary ip of another vm and leave a comment with the other vm
+    """
+    if not duplicates:
+        return []
+    tag_ids = get_tag_ids_by_object(VirtualMachine, {netbox_vm.id for netbox_vm, _ in duplicates})
+
+    commented_vms = {}
+    for netbox_vm, (owner_id, owner_name) in duplicates:
+        if repeated_tag and netbox_vm.id not in commented_vms:
+            tag_ids[netbox_vm.id] = reconcile_tags(netbox_vm, [repeated_tag],
+                                                   current_tag_ids=tag_ids.get(netbox_vm.id, set()))
+        comment = 'Duplicated ip - Name: {} - id {}'.format(owner_name, owner_id)
+        comments = netbox_vm.comments or ''
+        if comment not in comments:
+            netbox_vm.comments = comments + '\n' + comment
+            commented_vms[netbox_vm.id] = netbox_vm
+    return list(commented_vms.values())
+
+
+def reconcile_ip_addresses(items):
+    """
+    Apply the parsed (netbox_vm, interface name, ipv4, ipv6) items: every address is assigned to the interface of
+    its vm and set as its primary ip, unless another vm already has it as primary ip. All the writes are done in
+    one transaction, if it fails nothing is written and the vms are left as they were.
+    """
+    # Created before the transaction, a tag rolled back would stay in the cache of the job
+    repeated_tag = repeated_ip_tag()
+    saved = {item[0].id: (item[0].primary_ip4_id, item[0].primary_ip6_id, item[0].comments)
+             for item in items if item[0] is not None}
+    try:
+        with transaction.atomic():
+            return apply_ip_addresses(items, repeated_tag)
+    except Exception as e:
+        # Undo the changes made to the vms in memory, so a retry starts from what is in the database
+        for item in items:
+            netbox_vm = item[0]
+            if netbox_vm is not None and netbox_vm.id in saved:
+                netbox_vm.primary_ip4_id, netbox_vm.primary_ip6_id, netbox_vm.comments = saved[netbox_vm.id]
+        raise e
+
+
+def apply_ip_addresses(items, repeated_tag=None):
+    items = [item for item in items if item[0] is not None and item[0].id is not None]
+    if not items:
+        return 0
+    content_type = nb_cache.get_content_type("virtualization", "vminterface")
+
+    # (item, family, address) in the same order the per vm code applied them, ipv6 first
+    wanted = []
+    for item in items:
+        netbox_vm, name, ipv4, ipv6 = item
+        for family, address in ((6, ipv6), (4, ipv4)):
+            address = normalize_address(address)
+            if address is not None:
+                wanted.append((item, family, address))
+    if not wanted:
+        return 0
+
+    interfaces = get_interfaces(items)
+    interfaces_by_address = {}
+    for (netbox_vm, name, _, _), family, address in wanted:
+        interfaces_by_address.setdefault(address, interfaces[(netbox_vm.id, name)])
+    ip_addresses = get_ip_addresses(set(interfaces_by_address.keys()), interfaces_by_address, content_type)
+    owners = get_primary_ip_owners({netbox_ip.id for netbox_ip in ip_addresses.values()})
+
+    changed_ips = {}
+    changed_vms = {}
+    duplicates = []
+    for (netbox_vm, name, _, _), family, address in wanted:
+        netbox_ip = ip_addresses[address]
+        owner = owners.get((family, netbox_ip.id))
+        if owner is not None and owner[0] != netbox_vm.id:
+            duplicates.append((netbox_vm, owner))
+            continue
+
+        interface = interfaces[(netbox_vm.id, name)]
+        if netbox_ip.assigned_object_type_id != content_type.id or netbox_ip.assigned_object_id != interface.id:
+            netbox_ip.assigned_object_type_id = content_type.id
+            netbox_ip.assigned_object_id = interface.id
+            changed_ips[netbox_ip.id] = netbox_ip
+
+        field = PRIMARY_IP_FIELDS[family]
+        if getattr(netbox_vm, field) != netbox_ip.id:
+            setattr(netbox_vm, field, netbox_ip.id)
+            changed_vms[netbox_vm.id] = netbox_vm
+        owners[(family, netbox_ip.id)] = (netbox_vm.id, netbox_vm.name)
+
+    for netbox_vm in tag_duplicated_ips(duplicates, repeated_tag):
+        changed_vms[netbox_vm.id] = netbox_vm
+
+    if changed_ips:
+        IPAddress.objects.bulk_update(list(changed_ips.values()), ['assigned_object_type', 'assigned_object_id'])
+    if changed_vms:
+        VirtualMachine.objects.bulk_update(list(changed_vms.values()), ['primary_ip4', 'primary_ip6', 'comments'])
+    return len(changed_ips) + len(changed_vms)
+
+
+def store_pending_fingerprints(snapshot, failed_vm_ids=()):
+    """
+    Store with one query the fingerprints of the upserted vms, except the ones whose ip addresses failed: those keep
+    no fingerprint so the next job does not take the fast path for them and tries again
+    """
+    pending = snapshot.pending_fingerprints
+    snapshot.pending_fingerprints = {}
+    proxbox_vms = [ProxmoxVM(id=proxbox_id, fingerprint=fingerprint)
+                   for netbox_vm_id, (proxbox_id, fingerprint) in pending.items()
+                   if netbox_vm_id not in failed_vm_ids]
+    if proxbox_vms:
+        ProxmoxVM.objects.bulk_update(proxbox_vms, ['fingerprint'])
+    return len(proxbox_vms)
+
+
+def reconcile_snapshot_ip_addresses(snapshot):
+    """
+    Apply the addresses collected for a cluster and then store the fingerprints of its vms. If the batch fails
+    every vm is applied on its own, the vms that still fail are left without fingerprint.
+    """
+    items = snapshot.ip_items
+    snapshot.ip_items = []
+    failed_vm_ids = set()
+    try:
+        changed = reconcile_ip_addresses(items)
+    except Exception as e:
+        logger.error("Error: reconcile_snapshot_ip_addresses - %s, applying the %s vms one by one", e, len(items))
+        changed = 0
+        for item in items:
+            try:
+                changed += reconcile_ip_addresses([item])
+            except Exception as e:
+                logger.error("Error: reconcile_snapshot_ip_addresses - %s - %s", item[0], e)
+                if item[0] is not None and item[0].id is not None:
+                    failed_vm_ids.add(item[0].id)
+    store_pending_fingerprints(snapshot, failed_vm_ids)
+    return changed
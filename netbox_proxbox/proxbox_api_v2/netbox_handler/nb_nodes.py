@@ -3,11 +3,9 @@ from .nb_device_type import upsert_device_type
 from .nb_site import upsert_site
 from ..plugins_config import NETBOX_NODE_ROLE_ID, NETBOX_SITE_ID, NETBOX_MANUFACTURER
 
-# import logging
-import traceback
+import logging
 
-# logging.basicConfig(level=logging.DEBUG)
-# logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 try:
     from ipam.models import IPAddress
@@ -16,12 +14,11 @@ try:
     from dcim.choices import InterfaceTypeChoices
     from dcim.models import Manufacturer
     from .nb_tag import tag
-    from django.contrib.contenttypes.models import ContentType
+    from . import nb_cache
 
 
 except Exception as e:
-    # logger.exception(e)
-    traceback.print_exc()
+    logger.exception(e)
     raise e
 
 
@@ -173,7 +170,7 @@ def interface_ip_assign(netbox_node, proxmox_node):
     try:
         node_interface = get_set_interface('bond0', netbox_node)
         netbox_ip = IPAddress.objects.filter(address=ip).first()
-        content_type = ContentType.objects.filter(app_label="dcim", model="interface").first()
+        content_type = nb_cache.get_content_type("dcim", "interface")
         if netbox_ip is None:
             # Create the ip address and link it to the interface previously created
             netbox_ip = IPAddress(address=ip)
@@ -241,14 +238,14 @@ def upsert_nodes(proxmox_node):
     if netbox_node is None:
         # If node does not exist, create it.
         netbox_node = create_node(proxmox_node)
-        print("[OK] Node created! -> {}".format(proxmox_node.name))
+        logger.debug("Node created: %s", proxmox_node.name)
 
     if netbox_node is not None:
         # Update rest of configuration
         netbox_node = node_full_update(netbox_node, proxmox_node)
         # Analyze if update was successful
-        print('[OK] NODE {} updated.'.format(proxmox_node.name))
+        logger.debug("Node %s updated", proxmox_node.name)
     else:
-        print('[ERROR] Something went wrong when creating the node.-> {}'.format(proxmox_node.name))
+        logger.error("Error: something went wrong when creating the node %s", proxmox_node.name)
 
     return netbox_node
@@ -1,17 +1,31 @@
+import hashlib
+import json
 import pytz
 from django.db import connection, transaction
 from datetime import datetime
+from proxmoxer.core import ResourceException
 
 from .nb_virtualmachine import upsert_netbox_vm
+from .nb_failures import track_failures
 from ..plugins_config import PROXMOX_SESSIONS
+from ..proxmox.proxmox_config import ProxmoxConfigCache
+from .. import metrics
 
 from ...models import ProxmoxVM
 
-# import logging
+import logging
 import traceback
 
-# logging.basicConfig(level=logging.DEBUG)
-# logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
+
+# Outcome of get_proxmox_config for a vm not seen by the job
+VM_FOUND = 'found'
+VM_GONE = 'gone'
+VM_FETCH_FAILED = 'fetch_failed'
+
+# Values of the cluster/resources listing that describe the vm, the usage counters (cpu, mem, netin, uptime, ...)
+# change on every job and are left out of the fingerprint
+FINGERPRINT_RESOURCE_KEYS = ('name', 'node', 'type', 'status', 'template', 'vmid', 'maxcpu', 'maxmem', 'maxdisk')
 
 
 def get_resources(proxmox_vm):
@@ -29,6 +43,59 @@ def get_resources(proxmox_vm):
     return vcpus, memory_Mb, disk_Gb
 
 
+def get_fingerprint(proxmox_vm, config):
+    """
+    Hash of the normalized Proxmox resources and configuration of the vm, if it matches the one stored in the
+    ProxmoxVM nothing has to be written to NetBox for the vm
+    """
+    data = proxmox_vm.data or {}
+    resources = {key: data.get(key) for key in FINGERPRINT_RESOURCE_KEYS}
+    resources['cluster'] = proxmox_vm.cluster.name
+    # Proxmox already hashes the configuration in its digest, use it instead of serializing the whole configuration
+    if isinstance(config, dict) and config.get('digest'):
+        config = {'digest': config.get('digest')}
+    payload = json.dumps({'resources': resources, 'config': config}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def mark_proxbox_vms_seen(domain, vmids, job_id):
+    """
+    Stamp the job in all the vms of the domain that were seen by it with a single UPDATE, without saving (and
+    logging) every object
+    """
+    if not vmids:
+        return 0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE netbox_proxbox_proxmoxvm SET latest_job = %s, latest_update = %s "
+                "WHERE domain = %s AND proxmox_vm_id = ANY(%s)",
+                [str(job_id), (datetime.now()).replace(microsecond=0, tzinfo=pytz.utc), domain,
+                 [int(vmid) for vmid in vmids]])
+            return cursor.rowcount
+    except Exception as e:
+        # logger.exception(e)
+        # traceback.print_exc()
+        logger.error("Error: mark_proxbox_vms_seen - %s", e)
+        return 0
+
+
+def get_unchanged_proxbox_vm(proxmox_vm):
+    """
+    ProxmoxVM of the vm if it is fully synced and the fingerprint of the current resources with the configuration
+    stored by the previous job matches, None if the vm has to be synced
+    """
+    snapshot = proxmox_vm.cluster.nb_snapshot
+    if snapshot is None:
+        return None
+    proxbox_vm = snapshot.get_proxbox_vm(proxmox_vm.vmid, proxmox_vm.name)
+    if proxbox_vm is None or proxbox_vm.virtual_machine_id is None or proxbox_vm.config_data is None:
+        return None
+    if proxbox_vm.fingerprint != get_fingerprint(proxmox_vm, proxbox_vm.config_data):
+        return None
+    return proxbox_vm
+
+
 def upsert_proxbox_item(proxmox_vm) -> ProxmoxVM:
     proxmox_session = proxmox_vm.proxbox_session
     port = proxmox_session.http_port if proxmox_session.http_port else 8006
@@ -38,24 +105,44 @@ def upsert_proxbox_item(proxmox_vm) -> ProxmoxVM:
 
     config = None
     vm_type = proxmox_vm.type
+    config_cache = proxmox_vm.cluster.config_cache
     try:
-        if vm_type == 'qemu':
+        if config_cache is not None and config_cache.has(node, vmid):
+            config = config_cache.get(node, vmid)
+        elif vm_type == 'qemu':
             config = proxmox_session.session.nodes(node).qemu(vmid).config.get()
-        if vm_type == 'lxc':
+        elif vm_type == 'lxc':
             config = proxmox_session.session.nodes(node).lxc(vmid).config.get()
     except Exception as e:
-        print("Error: set_get_proxbox_item-1 - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: set_get_proxbox_item-1 - %s", e)
         config = None
 
     vcpus, memory_Mb, disk_Gb = get_resources(proxmox_vm)
 
-    proxbox_vm = ProxmoxVM.objects.filter(domain=domain, proxmox_vm_id=vmid).first()
-    if proxbox_vm is None:
-        proxbox_vm = ProxmoxVM.objects.filter(domain=domain, name=proxmox_vm.name).first()
-
+    snapshot = proxmox_vm.cluster.nb_snapshot
+    if snapshot is not None:
+        proxbox_vm = snapshot.get_proxbox_vm(vmid, proxmox_vm.name)
+    else:
+        proxbox_vm = ProxmoxVM.objects.filter(domain=domain, proxmox_vm_id=vmid).first()
+        if proxbox_vm is None:
+            proxbox_vm = ProxmoxVM.objects.filter(domain=domain, name=proxmox_vm.name).first()
+
+    # The job is stamped for all the vms seen with a single query at the end of the cluster
+    if snapshot is not None:
+        snapshot.seen_vmids.add(vmid)
+
+    # Fast path, nothing changed in proxmox since the latest job so only the job has to be stamped
+    fingerprint = get_fingerprint(proxmox_vm, config)
+    if config is not None and proxbox_vm is not None and proxbox_vm.virtual_machine_id is not None \
+            and proxbox_vm.fingerprint == fingerprint:
+        if snapshot is not None:
+            snapshot.unchanged_proxbox_ids.append(proxbox_vm.id)
+        else:
+            mark_proxbox_vms_seen(domain, [vmid], proxmox_vm.cluster.job_id)
+        metrics.count_object(domain, 'unchanged')
+        return proxbox_vm
+
+    metrics.count_object(domain, 'created' if proxbox_vm is None else 'updated')
     if proxbox_vm is None:
         proxbox_vm = ProxmoxVM(
             name=proxmox_vm.name,
@@ -84,11 +171,26 @@ def upsert_proxbox_item(proxmox_vm) -> ProxmoxVM:
 
         proxbox_vm.save()
 
-        netbox_vm = upsert_netbox_vm(proxmox_vm, config)
+        with track_failures() as failed_steps:
+            netbox_vm = upsert_netbox_vm(proxmox_vm, config)
         proxbox_vm.virtual_machine_id = netbox_vm.id
         proxbox_vm.virtual_machine = netbox_vm
+        # Only store the fingerprint once the vm was fully written to NetBox, a failed step is retried by the next job
+        if failed_steps:
+            logger.debug("Steps failed for %s, the next job syncs it again: %s", proxmox_vm.name,
+                         ', '.join(failed_steps))
+        complete = config is not None and not failed_steps
+        if snapshot is not None:
+            # The ip addresses of the cluster are applied in one batch later, the fingerprint waits for it
+            proxbox_vm.fingerprint = None
+            if complete:
+                snapshot.pending_fingerprints[netbox_vm.id] = (proxbox_vm.id, fingerprint)
+        else:
+            proxbox_vm.fingerprint = fingerprint if complete else None
 
         proxbox_vm.save()
+        if snapshot is not None:
+            snapshot.add_proxbox_vm(proxbox_vm)
 
     return proxbox_vm
 
@@ -102,12 +204,17 @@ def delete_proxbox_vm_sql(proxbox_id):
     except Exception as e:
         # logger.exception(e)
         # traceback.print_exc()
-        print("Error: delete_proxbox_vm_sql - {}".format(e))
-        print(e)
+        logger.error("Error: delete_proxbox_vm_sql - %s", e)
         return False
 
 
 def get_proxmox_config(vm):
+    """
+    Look up a vm not seen by the job in Proxmox, returns (config, proxbox_vm, domain, node, vmid, type, status):
+        VM_FOUND         the vm exists, config is only fetched when the proxbox registry is missing
+        VM_GONE          proxmox doesn't have the vm anymore
+        VM_FETCH_FAILED  proxmox couldn't be asked (node down, timeout, ...), nothing can be said about the vm
+    """
     config = None
     proxbox_vm = None
     domain = None
@@ -141,19 +248,50 @@ def get_proxmox_config(vm):
                     proxmox = proxmox_session.session
             except:
                 pass
+    except Exception as e:
+        logger.error("Error: get_promox_config-1 - %s", e)
+        return config, proxbox_vm, domain, node, vmid, type, VM_GONE
 
-        if proxmox is not None and node is not None and vmid is not None:
+    status = VM_GONE
+    try:
+        # Use the configuration fetched earlier in the job if there is one
+        config_cache = ProxmoxConfigCache.get_for_domain(domain) if domain is not None else None
+        if config_cache is not None and config_cache.has(node, vmid):
+            config = config_cache.get(node, vmid)
+            status = VM_FOUND
+        elif config_cache is not None and config_cache.has_listing():
+            location = config_cache.locate(vmid)
+            if location is not None:
+                # The vm is in the cluster/resources listing of the job, it exists whatever the fetch below
+                # returns. The job didn't sync it (migrated to another node, failed or skipped), its configuration
+                # is only fetched to create the missing proxbox registry, from the node it is in now
+                status = VM_FOUND
+                node, type = location
+                if proxbox_vm is None:
+                    try:
+                        config = config_cache.fetch_config(node, type, vmid)
+                    except Exception as e:
+                        logger.error("Error: get_promox_config-2 - %s %s", vmid, e)
+                    if config is None:
+                        status = VM_FETCH_FAILED
+            # Not in the cluster/resources listing of the job, the vm doesn't exist anymore
+        elif proxmox is not None and node is not None and vmid is not None:
             if type == 'qemu':
                 config = proxmox.nodes(node).qemu(vmid).config.get()
             if type == 'lxc':
                 config = proxmox.nodes(node).lxc(vmid).config.get()
+            if config is not None:
+                status = VM_FOUND
+    except ResourceException as e:
+        # Asked without a listing and proxmox answered with an error, the vm isn't there
+        logger.debug("Vm %s not found in %s - %s", vmid, domain, e)
+        config = None
+        status = VM_GONE
     except Exception as e:
-        print("Error: get_promox_config-1 - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: get_promox_config-3 - %s", e)
         config = None
-    return config, proxbox_vm, domain, node, vmid, type
+        status = VM_FETCH_FAILED
+    return config, proxbox_vm, domain, node, vmid, type, status
 
 
 def upsert_proxbox_from_vm(vm, domain, node, vmid, job_id, cluster, type, config):
@@ -0,0 +1,121 @@
+import asyncio
+from dataclasses import dataclass, field
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from virtualization.models import VirtualMachine
+except Exception as e:
+    logger.exception(e)
+    raise e
+
+from .nb_tag import get_tag_ids_by_object
+from ...models import ProxmoxVM
+
+
+@dataclass
+class NetboxSnapshot:
+    """
+    In memory copy of the NetBox state of one Proxmox cluster, loaded once per job so the upsert path
+    can resolve the VirtualMachine and ProxmoxVM of every vm without querying the database each time.
+    """
+    cluster_name: str = None
+    domain: str = None
+    # (cluster_name, vmid, node) -> VirtualMachine
+    netbox_vms_by_id: dict = field(default_factory=dict)
+    # (cluster_name, name) -> VirtualMachine
+    netbox_vms_by_name: dict = field(default_factory=dict)
+    # (domain, vmid) -> ProxmoxVM
+    proxbox_vms_by_id: dict = field(default_factory=dict)
+    # (domain, name) -> ProxmoxVM
+    proxbox_vms_by_name: dict = field(default_factory=dict)
+    # VirtualMachine id -> set of tag ids
+    netbox_vm_tag_ids: dict = field(default_factory=dict)
+    # ProxmoxVM ids whose fingerprint did not change in this job
+    unchanged_proxbox_ids: list = field(default_factory=list)
+    # Proxmox ids of the vms seen by the job, stamped with a single query at the end of the cluster
+    seen_vmids: set = field(default_factory=set)
+    # (netbox_vm, interface name, ipv4, ipv6) parsed by the upserts, applied at the end of the cluster
+    ip_items: list = field(default_factory=list)
+    # VirtualMachine id -> (ProxmoxVM id, fingerprint) of the upserted vms, stored once their ip addresses are
+    # applied so a job interrupted before that syncs them again
+    pending_fingerprints: dict = field(default_factory=dict)
+
+    @staticmethod
+    def _vmid_key(vmid):
+        # The custom field and the proxmox listing do not always agree on the type of the id
+        return str(vmid) if vmid is not None else None
+
+    def load(self):
+        netbox_vms = VirtualMachine.objects.filter(cluster__name=self.cluster_name)
+        netbox_vm_ids = []
+        for netbox_vm in netbox_vms:
+            self.add_netbox_vm(netbox_vm, replace=False)
+            netbox_vm_ids.append(netbox_vm.id)
+        self.netbox_vm_tag_ids = get_tag_ids_by_object(VirtualMachine, netbox_vm_ids)
+        for netbox_vm_id in netbox_vm_ids:
+            self.netbox_vm_tag_ids.setdefault(netbox_vm_id, set())
+
+        proxbox_vms = ProxmoxVM.objects.filter(domain=self.domain).defer('instance_data')
+        for proxbox_vm in proxbox_vms:
+            self.add_proxbox_vm(proxbox_vm, replace=False)
+        return self
+
+    def get_netbox_vm(self, vmid, node, name):
+        netbox_vm = self.netbox_vms_by_id.get((self.cluster_name, self._vmid_key(vmid), node))
+        if netbox_vm is None:
+            netbox_vm = self.netbox_vms_by_name.get((self.cluster_name, name))
+        return netbox_vm
+
+    def add_netbox_vm(self, netbox_vm, replace=True):
+        if netbox_vm is None:
+            return netbox_vm
+        # The first match wins when loading, the same as the .first() lookups it replaces
+        store = dict.__setitem__ if replace else dict.setdefault
+        custom_fields = netbox_vm.custom_field_data or {}
+        vmid = custom_fields.get("proxmox_id")
+        node = custom_fields.get("proxmox_node")
+        if vmid is not None and node is not None:
+            store(self.netbox_vms_by_id, (self.cluster_name, self._vmid_key(vmid), node), netbox_vm)
+        if netbox_vm.name:
+            store(self.netbox_vms_by_name, (self.cluster_name, netbox_vm.name), netbox_vm)
+        return netbox_vm
+
+    def get_tag_ids(self, netbox_vm):
+        """
+        Tag ids of a vm loaded with the snapshot, None if the vm was not loaded
+        """
+        return self.netbox_vm_tag_ids.get(netbox_vm.id)
+
+    def set_tag_ids(self, netbox_vm, tag_ids):
+        self.netbox_vm_tag_ids[netbox_vm.id] = tag_ids
+
+    def get_proxbox_vm(self, vmid, name):
+        proxbox_vm = self.proxbox_vms_by_id.get((self.domain, self._vmid_key(vmid)))
+        if proxbox_vm is None:
+            proxbox_vm = self.proxbox_vms_by_name.get((self.domain, name))
+        return proxbox_vm
+
+    def add_proxbox_vm(self, proxbox_vm, replace=True):
+        if proxbox_vm is None:
+            return proxbox_vm
+        store = dict.__setitem__ if replace else dict.setdefault
+        if proxbox_vm.proxmox_vm_id is not None:
+            store(self.proxbox_vms_by_id, (self.domain, self._vmid_key(proxbox_vm.proxmox_vm_id)), proxbox_vm)
+        if proxbox_vm.name:
+            store(self.proxbox_vms_by_name, (self.domain, proxbox_vm.name), proxbox_vm)
+        return proxbox_vm
+
+    @staticmethod
+    def instance_from_cluster(proxmox_cluster):
+        snapshot = NetboxSnapshot(
+            cluster_name=proxmox_cluster.name,
+            domain=proxmox_cluster.domain
+        )
+        return snapshot.load()
+
+    @staticmethod
+    async def async_instance_from_cluster(proxmox_cluster):
+        return await asyncio.to_thread(NetboxSnapshot.instance_from_cluster, proxmox_cluster)
@@ -0,0 +1,165 @@
+'''
+State of the scrapper jobs kept in SyncTask.
+
+Every job gets a START_SYNC task with the progress of the job, checkpointed as the domains finish, and the state of
+the cleanup in finish_remove_unused. A job that crashed can be resumed with its job id.
+
+Every domain synced by a job gets a START_CLUSTER_SYNC child task, checkpointed as the nodes finish, whose
+data_instance stores how it was synced:
+    {"full_sync": true, "partial": false, "task_hwm": 1666000000, "vms": 120, "synced": 4}
+task_hwm is the start time of the newest Proxmox task seen by the job, the next incremental job only syncs the
+vms with tasks after it. A partial sync (--node, --vmid) is never taken as the previous sync of the domain.
+'''
+from datetime import datetime, timedelta
+
+import pytz
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    from ...models import SyncTask
+    from ...choices import TaskTypeChoices, TaskStatusChoices, RemoveStatusChoices
+except Exception as e:
+    logger.exception(e)
+    raise e
+
+
+def _now():
+    return (datetime.now()).replace(microsecond=0, tzinfo=pytz.utc)
+
+
+def get_last_cluster_sync(domain, full_sync=None):
+    tasks = SyncTask.objects.filter(
+        task_type=TaskTypeChoices.START_CLUSTER_SYNC,
+        domain=domain,
+        status=TaskStatusChoices.STATUS_SUCCEEDED
+    )
+    if full_sync is not None:
+        tasks = tasks.filter(data_instance__full_sync=full_sync)
+    # A sync of some nodes or vms says nothing about the rest of the domain
+    tasks = tasks.exclude(data_instance__partial=True)
+    return tasks.order_by('-end_time').first()
+
+
+def is_full_sync_due(domain, interval):
+    """
+    True if the domain was never fully synced or the latest full sync is older than interval minutes
+    """
+    last_full_sync = get_last_cluster_sync(domain, full_sync=True)
+    if last_full_sync is None or last_full_sync.end_time is None:
+        return True
+    return last_full_sync.end_time < _now() - timedelta(minutes=interval or 0)
+
+
+def get_task_hwm(sync_task):
+    if sync_task is None or not sync_task.data_instance:
+        return None
+    return sync_task.data_instance.get('task_hwm')
+
+
+def get_job(job_id):
+    return SyncTask.objects.filter(task_type=TaskTypeChoices.START_SYNC, job_id=str(job_id)).first()
+
+
+def start_job(job_id, **data):
+    """
+    START_SYNC task of the job, the one of a resumed job is reused and set to running again
+    """
+    sync_task = get_job(job_id)
+    if sync_task is None:
+        sync_task = SyncTask(
+            name='Proxbox sync',
+            job_id=str(job_id),
+            task_type=TaskTypeChoices.START_SYNC,
+            start_time=_now(),
+            progress=0,
+            data_instance={}
+        )
+    sync_task.status = TaskStatusChoices.STATUS_RUNNING
+    sync_task.done = False
+    data_instance = sync_task.data_instance or {}
+    data_instance.update(data)
+    sync_task.data_instance = data_instance
+    sync_task.save()
+    return sync_task
+
+
+def get_completed_domains(job_id):
+    return set(SyncTask.objects.filter(
+        task_type=TaskTypeChoices.START_CLUSTER_SYNC,
+        job_id=str(job_id),
+        status=TaskStatusChoices.STATUS_SUCCEEDED
+    ).values_list('domain', flat=True))
+
+
+def checkpoint(sync_task, done, total, progress_status=None, **fields):
+    """
+    Store the progress of a task, only the progress columns are written
+    """
+    if sync_task is None:
+        return sync_task
+    try:
+        sync_task.progress = int(done * 100 / total) if total else 100
+        sync_task.progress_status = progress_status or '{}/{}'.format(done, total)
+        for key, value in fields.items():
+            setattr(sync_task, key, value)
+        SyncTask.objects.filter(id=sync_task.id).update(
+            progress=sync_task.progress,
+            progress_status=sync_task.progress_status,
+            **fields
+        )
+    except Exception as e:
+        logger.error("Error: checkpoint - %s", e)
+    return sync_task
+
+
+def start_cleanup(sync_task):
+    return checkpoint(sync_task, 0, 0, 'cleaning', finish_remove_unused=RemoveStatusChoices.REMOVING)
+
+
+def finish_cleanup(sync_task):
+    return checkpoint(sync_task, 1, 1, 'cleaned', finish_remove_unused=RemoveStatusChoices.FINISH)
+
+
+def is_cleanup_finished(sync_task):
+    return sync_task is not None and sync_task.finish_remove_unused == RemoveStatusChoices.FINISH
+
+
+def start_cluster_sync(domain, job_id, full_sync=True, parent=None, partial=False):
+    sync_task = SyncTask(
+        name='Sync {}'.format(domain),
+        job_id=str(job_id),
+        task_type=TaskTypeChoices.START_CLUSTER_SYNC,
+        status=TaskStatusChoices.STATUS_RUNNING,
+        domain=domain,
+        start_time=_now(),
+        progress=0,
+        parent=parent,
+        data_instance={'full_sync': full_sync, 'partial': partial}
+    )
+    sync_task.save()
+    return sync_task
+
+
+def finish_sync_task(sync_task, status=TaskStatusChoices.STATUS_SUCCEEDED, fail_reason=None, **data):
+    if sync_task is None:
+        return sync_task
+    try:
+        sync_task.status = status
+        sync_task.done = True
+        sync_task.end_time = _now()
+        if status == TaskStatusChoices.STATUS_SUCCEEDED:
+            sync_task.progress = 100
+        if sync_task.start_time is not None:
+            sync_task.duration = int((sync_task.end_time - sync_task.start_time).total_seconds())
+        if fail_reason is not None:
+            sync_task.fail_reason = str(fail_reason)[:512]
+        data_instance = sync_task.data_instance or {}
+        data_instance.update(data)
+        sync_task.data_instance = data_instance
+        sync_task.save()
+    except Exception as e:
+        logger.error("Error: finish_sync_task - %s", e)
+    return sync_task
@@ -1,39 +1,35 @@
 from django.template.defaultfilters import slugify
-import re
 
-from netbox_proxbox.proxbox_api_v2.plugins_config import NETBOX_TENANT_REGEX_VALIDATOR, NETBOX_TENANT_NAME, \
-    NETBOX_TENANT_DESCRIPTION
+from netbox_proxbox.proxbox_api_v2.plugins_config import NETBOX_TENANT_NAME, NETBOX_TENANT_DESCRIPTION
 
-# import logging
-import traceback
+import logging
 
-# logging.basicConfig(level=logging.DEBUG)
-# logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 try:
-    from extras.models import Tag
+    from extras.models import Tag, TaggedItem
+    from . import nb_cache
+    from .nb_description import has_tenant_string
+    from .nb_failures import report_failure
 
 except Exception as e:
-    # logger.exception(e)
-    traceback.print_exc()
+    logger.exception(e)
     raise e
 
 
 #
 def validate_custom_tag(name):
-    has_string = False
-    try:
-        rgx = r"" + NETBOX_TENANT_REGEX_VALIDATOR
-        matches = re.finditer(rgx, name, re.MULTILINE | re.IGNORECASE)
-        it = matches.__next__()
-        it.group().lower().strip()
-        has_string = True
-    except Exception as e:
-        pass
-    return has_string
+    return has_tenant_string(name)
 
 
 def custom_tag(tag_name="Proxbox", tag_slug="proxbox", tag_description="No description", color='ff5722'):
+    return nb_cache.get_or_load(
+        'tag', tag_slug,
+        lambda: upsert_custom_tag(tag_name, tag_slug, tag_description, color)
+    )
+
+
+def upsert_custom_tag(tag_name, tag_slug, tag_description, color):
     # Check if Proxbox tag already exists.
     proxbox_tag = Tag.objects.filter(slug=tag_slug).first()
 
@@ -48,11 +44,9 @@ def custom_tag(tag_name="Proxbox", tag_slug="proxbox", tag_description="No descr
             )
             output.save()
         except Exception as e:
-            # logger.exception(e)
-            # traceback.print_exc()
-            print(e)
-            print("Error creating the '{0}' tag. Possible errors: the name '{0}' or slug '{1}' is already used.".format(
-                tag_name, tag_slug))
+            logger.error("Error creating the '%s' tag. Possible errors: the name '%s' or slug '%s' is already used. %s",
+                         tag_name, tag_name, tag_slug, e)
+            report_failure('upsert_custom_tag')
             return None
     else:
         output = proxbox_tag
@@ -70,25 +64,74 @@ def tag():
     return custom_tag(proxbox_tag_name, proxbox_tag_slug, description)
 
 
-def base_tag(netbox_vm, other_tags=None):
-    # Get current tags
-    tags = netbox_vm.tags.all()
+def get_tag_ids(netbox_obj):
+    """
+    Ids of the tags of the object read straight from the through table in one query
+    """
+    content_type = nb_cache.get_content_type(netbox_obj._meta.app_label, netbox_obj._meta.model_name)
+    return set(TaggedItem.objects.filter(
+        content_type_id=content_type.id,
+        object_id=netbox_obj.id
+    ).values_list('tag_id', flat=True))
+
+
+def get_tag_ids_by_object(model, object_ids):
+    """
+    object id -> set of tag ids for all the objects, in one query
+    """
+    output = {}
+    if not object_ids:
+        return output
+    content_type = nb_cache.get_content_type(model._meta.app_label, model._meta.model_name)
+    items = TaggedItem.objects.filter(
+        content_type_id=content_type.id,
+        object_id__in=list(object_ids)
+    ).values_list('object_id', 'tag_id')
+    for object_id, tag_id in items:
+        output.setdefault(object_id, set()).add(tag_id)
+    return output
 
-    # Get tag names from tag objects
-    tags_name = []
-    for c_tag in tags:
-        tags_name.append(c_tag.name)
 
-    # If Proxbox not found int Netbox tag's list, update object with the tag.
-    sve_custom = False
-    p_tag = tag()
-    if p_tag.name not in tags_name:
-        netbox_vm.tags.add(p_tag)
-        # Save new tag to object
-        sve_custom = True
+def reconcile_tags(netbox_obj, desired_tags, unwanted_tags=None, current_tag_ids=None):
+    """
+    Apply the difference between the current and the desired tags of the object with one bulk insert of the
+    missing rows and one delete of the unwanted ones. Tags that are neither desired nor unwanted are left alone,
+    so tags set by hand in NetBox are kept.
+    """
+    content_type = nb_cache.get_content_type(netbox_obj._meta.app_label, netbox_obj._meta.model_name)
+    if current_tag_ids is None:
+        current_tag_ids = get_tag_ids(netbox_obj)
+
+    desired_ids = {t.id for t in desired_tags if t is not None}
+    unwanted_ids = {t.id for t in (unwanted_tags or []) if t is not None} - desired_ids
+
+    missing_ids = desired_ids - current_tag_ids
+    extra_ids = unwanted_ids & current_tag_ids
+
+    if missing_ids:
+        TaggedItem.objects.bulk_create([
+            TaggedItem(content_type_id=content_type.id, object_id=netbox_obj.id, tag_id=tag_id)
+            for tag_id in missing_ids
+        ], ignore_conflicts=True)
+    if extra_ids:
+        TaggedItem.objects.filter(
+            content_type_id=content_type.id,
+            object_id=netbox_obj.id,
+            tag_id__in=extra_ids
+        ).delete()
+
+    return (current_tag_ids | missing_ids) - extra_ids
+
+
+def base_tag(netbox_vm, other_tags=None, current_tag_ids=None):
+    """
+    Reconcile the tags proxbox manages on the vm, returns the vm and the tag ids it has afterwards
+    """
+    # Desired tags of the vm, and the tags proxbox manages that the vm should not have
+    desired_tags = [tag()]
+    unwanted_tags = []
 
     # custom edgeuno tags
-
     has_string = validate_custom_tag(netbox_vm.name)
 
     customer_tag_name = "Customer"
@@ -102,36 +145,23 @@ def base_tag(netbox_vm, other_tags=None):
         e1_observation = NETBOX_TENANT_DESCRIPTION
         e1_tag = custom_tag(e1_tag_name, e1_tag_slug, e1_observation)
 
-        if has_string and NETBOX_TENANT_NAME is not None:
-            if customer_tag in tags:
-                netbox_vm.tags.remove(customer_tag)
-            if e1_tag not in tags:
-                netbox_vm.tags.add(e1_tag)
-                sve_custom = True
+        if has_string:
+            desired_tags.append(e1_tag)
+            unwanted_tags.append(customer_tag)
         else:
-            if e1_tag in tags:
-                netbox_vm.tags.remove(e1_tag)
-            if customer_tag not in tags:
-                netbox_vm.tags.add(customer_tag)
-                sve_custom = True
+            desired_tags.append(customer_tag)
+            unwanted_tags.append(e1_tag)
 
     if other_tags is not None:
         for t in other_tags:
             try:
                 custom_tag_name = t
                 custom_tag_slug = t.replace(" ", "_").lower()
-                custom_tag_obj = custom_tag(custom_tag_name, custom_tag_slug, t)
-                if custom_tag_obj.id not in tags:
-                    netbox_vm.tags.add(custom_tag)
-                    sve_custom = True
+                desired_tags.append(custom_tag(custom_tag_name, custom_tag_slug, t))
             except Exception as e:
-                # logger.exception(e)
-                # traceback.print_exc()
-                print(e)
-                print("Error: base_tag-other_tags - {}".format(e))
-
+                logger.error("Error: base_tag-other_tags - %s", e)
+                report_failure('base_tag-other_tags')
 
-    if sve_custom:
-        netbox_vm.save()
+    tag_ids = reconcile_tags(netbox_vm, desired_tags, unwanted_tags, current_tag_ids)
 
-    return netbox_vm
+    return netbox_vm, tag_ids
@@ -1,34 +1,32 @@
 from ...others.db import namedtuplefetchall
 import asyncio
-from django.utils import timezone
 import pytz
 from datetime import datetime
 
-# import logging
+import logging
 import traceback
 
-# logging.basicConfig(level=logging.DEBUG)
-# logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 try:
     from django.db import connection, transaction
     from django.template.defaultfilters import slugify
-    from virtualization.models import VirtualMachine, VMInterface
+    from virtualization.models import VirtualMachine
     from tenancy.models import Tenant, TenantGroup, Contact, ContactRole, ContactAssignment
-    from ipam.models import IPAddress
-    from django.contrib.contenttypes.models import ContentType
-    from dcim.choices import InterfaceTypeChoices
 
     from .nb_device_role import upsert_role
     from ..plugins_config import (
         NETBOX_TENANT_NAME,
-        NETBOX_TENANT_REGEX_VALIDATOR,
         NETBOX_VM_ROLE_ID,
         NETBOX_VM_ROLE_NAME,
     )
 
-    from .nb_tag import tag, custom_tag, base_tag
-    import re
+    from .nb_tag import tag, base_tag
+    from .nb_ipaddress import reconcile_ip_addresses
+    from .nb_failures import report_failure
+    from .nb_description import parse_description, parse_network, has_tenant_string
+    from . import nb_cache
+    from .. import metrics
 
 
 except Exception as e:
@@ -36,10 +34,6 @@ except Exception as e:
     traceback.print_exc()
     raise e
 
-ipv4_regex = r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(\/\d{1,3})?"
-ipv6_regex = r"([a-zA-Z0-9]{1,4}(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?:([a-zA-Z0-9]{0,4})?:([a-zA-Z0-9]{0,4})?(\.\d{1,3}\.\d{1,3}\.\d{1,3})?(\/\d{1,3})?)"
-
-
 def base_local_context_data(netbox_vm, proxmox_vm):
     current_local_context = netbox_vm.local_context_data
 
@@ -138,6 +132,17 @@ def upsert_tenant_group(tenant, netbox_vm):
             tags_name.append(c_tag.name.lower())
     if NETBOX_TENANT_NAME is not None and NETBOX_TENANT_NAME.lower() in tags_name:
         tenant_group_name = NETBOX_TENANT_NAME
+    tenant_group = nb_cache.get_or_load('tenant_group', tenant_group_name,
+                                        lambda: upsert_tenant_group_by_name(tenant_group_name))
+    # The tenant is shared by many vms, only write it when the group changes
+    if tenant.group_id != tenant_group.id:
+        tenant.group_id = tenant_group.id
+        tenant.group = tenant_group
+        tenant.save()
+    return tenant
+
+
+def upsert_tenant_group_by_name(tenant_group_name):
     tenant_group = TenantGroup.objects.filter(name=tenant_group_name).first()
     if tenant_group is None:
         tenant_group = TenantGroup(
@@ -145,34 +150,27 @@ def upsert_tenant_group(tenant, netbox_vm):
             slug=slugify(tenant_group_name)
         )
         tenant_group.save()
-    tenant.group_id = tenant_group.id
-    tenant.group = tenant_group
-    tenant.save()
-    return tenant
+    return tenant_group
+
+
+def upsert_tenant_by_name(tenant_name):
+    nb_tenant = Tenant.objects.filter(name=tenant_name).first()
+    if nb_tenant is None:
+        nb_tenant = Tenant(
+            name=tenant_name,
+            slug=slugify(tenant_name)
+        )
+        nb_tenant.save()
+    return nb_tenant
 
 
 def default_tenant(netbox_vm):
-    has_string = False
-    try:
-        rgx = r"" + NETBOX_TENANT_REGEX_VALIDATOR
-        matches = re.finditer(rgx, netbox_vm.name, re.MULTILINE | re.IGNORECASE)
-        it = matches.__next__()
-        it.group().lower().strip()
-        has_string = True
-    except Exception as e:
-        pass
-        # print("Error: default_tenant-1 - {}".format(e))
-        # print(e)
+    has_string = has_tenant_string(netbox_vm.name)
 
     if has_string:
         if NETBOX_TENANT_NAME is not None:
-            nb_tenant = Tenant.objects.filter(name=NETBOX_TENANT_NAME).first()
-            if nb_tenant is None:
-                nb_tenant = Tenant(
-                    name=NETBOX_TENANT_NAME,
-                    slug=slugify(NETBOX_TENANT_NAME)
-                )
-                nb_tenant.save()
+            nb_tenant = nb_cache.get_or_load('tenant', NETBOX_TENANT_NAME,
+                                             lambda: upsert_tenant_by_name(NETBOX_TENANT_NAME))
             if nb_tenant is not None:
                 nb_tenant = upsert_tenant_group(nb_tenant, netbox_vm)
                 netbox_vm.tenant_id = nb_tenant.id
@@ -183,45 +181,8 @@ def default_tenant(netbox_vm):
 
 
 def client_tenant_parser(test_str):
-    client = None
-    tenant_name = None
-    client_regex = r"client(\s)?(:)?.*(id)?:"
-    try:
-        matches = re.finditer(client_regex, test_str, re.MULTILINE | re.IGNORECASE)
-        it = matches.__next__()
-        client = it.group() \
-            .replace('client:', '') \
-            .replace('client :', '') \
-            .replace('Client:', '') \
-            .replace('Client :', '') \
-            .replace('id:', '') \
-            .replace('id :', '') \
-            .replace('(id :', '') \
-            .replace('(ID:', '') \
-            .replace('Id:', '') \
-            .replace('Id :', '') \
-            .replace('(Id :', '') \
-            .replace('(ID :', '') \
-            .strip()
-        sub_str_regex = r"\(.*\)"
-        m_result = None
-        try:
-            m_result = re.finditer(sub_str_regex, client, re.MULTILINE | re.IGNORECASE).__next__().group().strip()
-        except Exception as e:
-            # print("Error: client_tenant_parser - {}".format(e))
-            # print(e)
-            pass
-        if m_result:
-            if m_result.replace('(', '').replace(')', '').strip():
-                tenant_name = m_result.replace('(', '').replace(')', '').strip()
-            client = client.replace(m_result, '').strip()
-        else:
-            tenant_name = client
-        # print('[OK] Tenant parse. -> {}'.format(client))
-    except Exception as e:
-        # print("Error: client_tenant_parser-all - {}".format(e))
-        pass
-    return tenant_name, client
+    description = parse_description(test_str)
+    return description.tenant_name, description.client
 
 
 def contact_parse_set(test_str, name):
@@ -229,54 +190,46 @@ def contact_parse_set(test_str, name):
     contact_role = None
     try:
         # print('[OK] Parsing contact from. -> {}'.format(test_str))
-        contact_email = None
-        contact_regex = r"email(\s)?(:)?(\s)?\w+([\.-]?\w+)*@\w+([\.-]?\w+)*(\.\w{2,3})+"
-        try:
-            matches = re.finditer(contact_regex, test_str, re.MULTILINE | re.IGNORECASE)
-            it = matches.__next__()
-            contact_email = it.group() \
-                .replace('email:', '') \
-                .replace('email :', '') \
-                .replace('Email:', '') \
-                .replace('Email :', '') \
-                .strip()
-            # print('[OK] Contact email parsed. -> {}'.format(contact_email))
-        except Exception as e:
-            # print("Error: contact_parse_set - {}".format(e))
-            # print(e)
-            pass
+        contact_email = parse_description(test_str).contact_email
         if contact_email is None:
             return None, None
 
-        contact = Contact.objects.filter(email=contact_email).first()
-        if contact is None:
-            # print('[OK] Creating contact for {} with email {}'.format(name, contact_email))
-            # new_contact = {"name": name, "email": contact_email}
-            contact = Contact(
-                name=name,
-                email=contact_email
-            )
-            contact.save()
-
-        contact_role = ContactRole.objects.filter(name="vm").first()
-        if contact_role is None:
-            # print('[OK] Creating role. -> {}'.format("vm"))
-            contact_role = ContactRole(
-                name="vm",
-                slug=slugify("vm")
-            )
-            contact_role.save()
+        contact = nb_cache.get_or_load('contact', contact_email, lambda: upsert_contact(name, contact_email))
+        contact_role = nb_cache.get_or_load('contact_role', "vm", lambda: upsert_contact_role("vm"))
     except Exception as e:
-        print("Error: contact_parse_set - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: contact_parse_set - %s", e)
+        report_failure('contact_parse_set')
     return contact, contact_role
 
 
+def upsert_contact(name, contact_email):
+    contact = Contact.objects.filter(email=contact_email).first()
+    if contact is None:
+        # print('[OK] Creating contact for {} with email {}'.format(name, contact_email))
+        # new_contact = {"name": name, "email": contact_email}
+        contact = Contact(
+            name=name,
+            email=contact_email
+        )
+        contact.save()
+    return contact
+
+
+def upsert_contact_role(role_name):
+    contact_role = ContactRole.objects.filter(name=role_name).first()
+    if contact_role is None:
+        # print('[OK] Creating role. -> {}'.format(role_name))
+        contact_role = ContactRole(
+            name=role_name,
+            slug=slugify(role_name)
+        )
+        contact_role.save()
+    return contact_role
+
+
 def set_assign_contact(test_str, name, object_id, content_type):
     if content_type is None:
-        content_type = ContentType.objects.filter(app_label="tenancy", model="tenant").first()
+        content_type = nb_cache.get_content_type("tenancy", "tenant")
 
     contact = None
     contact_role = None
@@ -307,17 +260,12 @@ def set_assign_contact(test_str, name, object_id, content_type):
             # print('[OK] Contact assigned {} to tenant {}'.format(contact.name, name))
             # assign_contact_to_tenant(tenant, contact, contact_role, content_type)
     except Exception as e:
-        print("Error: set_assign_contact - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: set_assign_contact - %s", e)
+        report_failure('set_assign_contact')
     return contact, contact_role, contact_assigment
 
 
-def get_set_tenant_from_configuration(test_str):
-    tenant_name, client = client_tenant_parser(test_str)
-    if tenant_name is None:
-        return None
+def get_set_tenant_by_name(tenant_name):
     nb_tenant = Tenant.objects.filter(name=tenant_name).first()
 
     if nb_tenant is None:
@@ -331,11 +279,17 @@ def get_set_tenant_from_configuration(test_str):
             )
             nb_tenant.save()
         except Exception as e:
-            # logger.exception(e)
-            # traceback.print_exc()
-            print(e)
+            logger.error("Error: get_set_tenant_by_name - %s", e)
             raise e
-    content_type = ContentType.objects.filter(app_label="tenancy", model="tenant").first()
+    return nb_tenant
+
+
+def get_set_tenant_from_configuration(test_str):
+    tenant_name, client = client_tenant_parser(test_str)
+    if tenant_name is None:
+        return None
+    nb_tenant = nb_cache.get_or_load('tenant', tenant_name, lambda: get_set_tenant_by_name(tenant_name))
+    content_type = nb_cache.get_content_type("tenancy", "tenant")
     # set_assign_contact(test_str, client, nb_tenant.id, 'tenancy.tenant')
     set_assign_contact(test_str, client, nb_tenant.id, content_type)
     return nb_tenant
@@ -358,7 +312,7 @@ def set_tenant(netbox_vm, observation):
 
 def set_contact_to_vm(test_str, netbox_vm):
     # content_type = 'virtualization.virtualmachine'
-    content_type = ContentType.objects.filter(app_label="virtualization", model="virtualmachine").first()
+    content_type = nb_cache.get_content_type("virtualization", "virtualmachine")
     try:
         # print('[OK] Parsing contact from. -> {}'.format(test_str))
         tenant = netbox_vm.tenant
@@ -366,10 +320,8 @@ def set_contact_to_vm(test_str, netbox_vm):
         set_assign_contact(test_str, client, netbox_vm.id, content_type)
         return netbox_vm
     except Exception as e:
-        print("Error: set_contact_to_vm - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: set_contact_to_vm - %s", e)
+        report_failure('set_contact_to_vm')
         return netbox_vm
 
 
@@ -378,10 +330,8 @@ def base_add_configuration(netbox_vm, proxmox_vm, config=None):
         if NETBOX_TENANT_NAME is not None:
             netbox_vm = default_tenant(netbox_vm)
     except Exception as e1:
-        print("Error: base_add_configuration-1 - {}".format(e1))
-        # logger.exception(e1)
-        # traceback.print_exc()
-        print(e1)
+        logger.error("Error: base_add_configuration-1 - %s", e1)
+        report_failure('base_add_configuration-1')
 
     if config is None:
         return netbox_vm
@@ -396,10 +346,8 @@ def base_add_configuration(netbox_vm, proxmox_vm, config=None):
         # else:
         # print('no description')
     except Exception as e2:
-        print("Error: base_add_configuration-3 - {}".format(e2))
-        # logger.exception(e2)
-        # traceback.print_exc()
-        print(e2)
+        logger.error("Error: base_add_configuration-3 - %s", e2)
+        report_failure('base_add_configuration-3')
     return netbox_vm
 
 
@@ -419,197 +367,24 @@ def update_vm_role(netbox_vm, proxmox_vm):
         netbox_vm.role = role
         netbox_vm.save()
     except Exception as e:
-        print("Error: update_vm_role - {}".format(e))
-        print("[update_vm_role] Updating vm role fails")
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: update_vm_role - Updating vm role fails - %s", e)
+        report_failure('update_vm_role')
     return netbox_vm
 
 
 def get_ip(test_str):
-    # print('[OK] parsing ipv4. -> {}'.format(test_str))
-    regex = r"ip=" + ipv4_regex
     # test_str = "name=eth0,bridge=vmbr504,firewall=1,gw=172.16.19.1,hwaddr=5A:70:3F:05:0D:AC,ip=172.16.19.251/24,type=veth"
-    try:
-        matches = re.finditer(regex, test_str, re.MULTILINE)
-        it = matches.__next__()
-        ip = it.group().replace('ip=', '').strip()
-        # print('[OK] Parse. -> {}'.format(ip))
-        return ip
-    except Exception as e:
-        # print("Error: get_ip - {}".format(e))
-        return None
+    return parse_network(test_str)[0]
 
 
 def get_ipv6(test_str):
-    # ipv6 regex
-    # print('[OK] parsing ipv6. -> {}'.format(test_str))
-    regex = r"ip6=" + ipv6_regex
-
     # test_str = "name=eth0,bridge=vmbr502,gw=172.16.17.1,gw6=fc00:16:17::1,hwaddr=CA:F3:00:D6:31:2A,ip=172.16.17.203/24,ip6=2001:db8:3:4::192.0.2.33/64,type=veth"
-    try:
-        matches = re.finditer(regex, test_str, re.MULTILINE | re.IGNORECASE)
-        it = matches.__next__()
-        ip = it.group().replace('ip6=', '').strip()
-        # print('[OK] Parse. -> {}'.format(ip))
-        return ip
-    except Exception as e:
-        # print("Error: get_ipv6 - {}".format(e))
-        return None
+    return parse_network(test_str)[1]
 
 
 def get_main_ip(test_str):
-    ipv4 = None
-    ipv6 = None
-
-    try:
-        # print('[OK] Parsing main ip for ipv4 -> {}').format(test_str)
-        rgx = r"main(\s)?ip:(\s)?"
-        matches = re.finditer(rgx + ipv4_regex, test_str, re.MULTILINE | re.IGNORECASE)
-        it = matches.__next__()
-        ipv4 = it.group().lower() \
-            .replace('mainip:', '') \
-            .replace('mainip: ', '') \
-            .replace('main ip:', '') \
-            .replace('main ip: ', '') \
-            .strip()
-        ipv4 = (re.sub(rgx, '', ipv4)).strip()
-    except Exception as e:
-        # print("Error: get_main_ip-ip4 - {}".format(e))
-        pass
-    try:
-        # print('[OK] Parsing main ip for ipv6')
-        rgx = r"main(\s)?ip:(\s)?"
-        matches = re.finditer(rgx + ipv6_regex, test_str, re.MULTILINE | re.IGNORECASE)
-        it = matches.__next__()
-        ipv6 = it.group().lower() \
-            .replace('mainip:', '') \
-            .replace('mainip: ', '') \
-            .replace('main ip:', '') \
-            .replace('main ip: ', '') \
-            .strip()
-        ipv6 = (re.sub(rgx, '', ipv6)).strip()
-    except Exception as e:
-        # print("Error: get_main_ip-ip6 - {}".format(e))
-        pass
-    try:
-        if ipv4 is None:
-            # print('[OK] Parsing ip address allocation for ipv4')
-            rgx = r"ip(\s)?address(\s)?allocation:(\s)?"
-            matches = re.finditer(rgx + ipv4_regex, test_str, re.MULTILINE | re.IGNORECASE)
-            it = matches.__next__()
-            ipv4 = it.group().lower() \
-                .replace('ipaddressallocation:', '') \
-                .replace('ipaddressallocation :', '') \
-                .replace('ip addressallocation:', '') \
-                .replace('ip addressallocation :', '') \
-                .replace('ip address allocation:', '') \
-                .replace('ip address allocation :', '') \
-                .strip()
-            ipv4 = (re.sub(rgx, '', ipv4)).strip()
-    except Exception as e:
-        # print("Error: get_main_ip-ip4-location - {}".format(e))
-        pass
-    try:
-        if ipv6 is None:
-            # print('[OK] Parsing ip address allocation for ipv6')
-            rgx = r"ip(\s)?address(\s)?allocation:(\s)?"
-            matches = re.finditer(rgx + ipv6_regex, test_str, re.MULTILINE | re.IGNORECASE)
-            it = matches.__next__()
-            ipv6 = it.group().lower() \
-                .replace('ipaddressallocation:', '') \
-                .replace('ipaddressallocation :', '') \
-                .replace('ip addressallocation:', '') \
-                .replace('ip addressallocation :', '') \
-                .replace('ip address allocation:', '') \
-                .replace('ip address allocation :', '') \
-                .strip()
-            ipv6 = (re.sub(rgx, '', ipv6)).strip()
-    except Exception as e:
-        # print("Error: get_main_ip-ip6-allocation - {}".format(e))
-        pass
-    return ipv4, ipv6
-
-
-def upsert_interface(name, netbox_node):
-    dev_interface = VMInterface.objects.filter(name=name, virtual_machine_id=netbox_node.id).first()
-    if dev_interface is None:
-        # new_interface_json = {"device_id": netbox_node.id, "name": name, type: InterfaceTypeChoices.TYPE_LAG}
-        dev_interface = VMInterface(name=name)
-        dev_interface.description = "LAG"
-        dev_interface.virtual_machine_id = netbox_node.id
-        dev_interface.virtual_machine = netbox_node
-        dev_interface.type = InterfaceTypeChoices.TYPE_LAG
-        dev_interface.save()
-
-    return dev_interface
-
-
-def handle_ip_already_set(netbox_vm, netbox_ip, family=4):
-    netbox_vm_with_ip = None
-    # Check for ipv4 or ipv6 if there is a vm with the same ip
-    if family == 4:
-        netbox_vm_with_ip = VirtualMachine.objects.filter(primary_ip4_id=netbox_ip.id).first()
-    else:
-        netbox_vm_with_ip = VirtualMachine.objects.filter(primary_ip6_id=netbox_ip.id).first()
-    # If there is not vm with the ip or is the same as the incoming vm
-    if netbox_vm_with_ip is None or netbox_vm.id == netbox_vm_with_ip.id:
-        return netbox_vm, netbox_ip
-    # If the netbox_vm is not the same as the netbox_vm_with_ip then we are going to set up a tag and a comment
-    # with the ip and the vm id that has the same ip
-    name = 'Repeated Ip'
-    tag_description = "No description"
-    color = 'ff3c3f'
-    repeated_tag = custom_tag(name, slugify(name), tag_description, color)
-    if repeated_tag:
-        netbox_vm.tags.add(repeated_tag)
-    netbox_vm.comments = netbox_vm.comments + '\nDuplicated ip - Name: {} - id {}'.format(netbox_vm_with_ip.name,
-                                                                                          netbox_vm_with_ip.id)
-    netbox_vm.save()
-    return netbox_vm, None
-
-
-def set_ipv(netbox_vm, vm_interface, ip, family=4):
-    if ip is not None:
-        # Search the ip in netbox and get the content type for virtualization
-        netbox_ip = IPAddress.objects.filter(address=ip).first()
-        content_type = ContentType.objects.filter(app_label="virtualization", model="vminterface").first()
-        if netbox_ip is None:
-            # Create the ip address and link it to the interface previously created
-            netbox_ip = IPAddress(address=ip)
-            netbox_ip.assigned_object_type = content_type
-            netbox_ip.assigned_object_id = vm_interface.id
-            netbox_ip.assigned_object = vm_interface
-            netbox_ip.save()
-
-        netbox_vm, netbox_ip = handle_ip_already_set(netbox_vm, netbox_ip, family)
-        if netbox_ip:
-            # Associate the ip address to the interface
-            netbox_ip.assigned_object_type = content_type
-            netbox_ip.assigned_object_id = vm_interface.id
-            netbox_ip.assigned_object = vm_interface
-            netbox_ip.save()
-
-            if family == 4:
-                netbox_vm.primary_ip4 = netbox_ip
-                netbox_vm.primary_ip4_id = netbox_ip.id
-            else:
-                netbox_vm.primary_ip6 = netbox_ip
-                netbox_vm.primary_ip6_id = netbox_ip.id
-
-            netbox_vm.primary_ip_id = netbox_ip.id
-
-            # netbox_vm.save()
-    return netbox_vm
-
-
-def set_ipv4(netbox_vm, vm_interface, ipv4):
-    return set_ipv(netbox_vm, vm_interface, ipv4, 4)
-
-
-def set_ipv6(netbox_vm, vm_interface, ipv6):
-    return set_ipv(netbox_vm, vm_interface, ipv6, 6)
+    description = parse_description(test_str)
+    return description.main_ipv4, description.main_ipv6
 
 
 def base_add_ip(netbox_vm, proxmox_vm, config=None):
@@ -630,10 +405,8 @@ def base_add_ip(netbox_vm, proxmox_vm, config=None):
             elif 'ipconfig0' in config:
                 network_str = config['ipconfig0']
     except  Exception as e:
-        print("Error: base_add_ip-2 - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: base_add_ip-2 - %s", e)
+        report_failure('base_add_ip-2')
         network_str = None
 
     try:
@@ -645,22 +418,20 @@ def base_add_ip(netbox_vm, proxmox_vm, config=None):
                 if 'description' in config:
                     ipv4, ipv6 = get_main_ip(config['description'])
             if not (ipv4 is None and ipv6 is None):
-                try:
-                    # Create the interface if it doesn't exist
-                    vm_interface = upsert_interface('eth0', netbox_vm)
-                    netbox_vm = set_ipv6(netbox_vm, vm_interface, ipv6)
-                    netbox_vm = set_ipv4(netbox_vm, vm_interface, ipv4)
-                except Exception as e:
-                    print("Error: base_add_ip-3 - {}".format(e))
-                    # print(e)
-                    # traceback.print_exc()
-                    print(e)
-                netbox_vm.save()
+                item = (netbox_vm, 'eth0', ipv4, ipv6)
+                snapshot = proxmox_vm.cluster.nb_snapshot if proxmox_vm.cluster is not None else None
+                if snapshot is not None:
+                    # Applied together with the rest of the cluster once all the vms are upserted
+                    snapshot.ip_items.append(item)
+                else:
+                    try:
+                        reconcile_ip_addresses([item])
+                    except Exception as e:
+                        logger.error("Error: base_add_ip-3 - %s", e)
+                        report_failure('base_add_ip-3')
     except Exception as e:
-        print("Error: base_add_ip-4 - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: base_add_ip-4 - %s", e)
+        report_failure('base_add_ip-4')
     return netbox_vm
 
 
@@ -670,10 +441,14 @@ def upsert_netbox_vm(proxmox_vm, config=None):
     vmid = proxmox_vm.vmid
     node = proxmox_vm.node
 
-    netbox_vm = VirtualMachine.objects.filter(cluster__name=cluster_name, custom_field_data__proxmox_id=vmid,
-                                              custom_field_data__proxmox_node=node).first()
-    if netbox_vm is None:
-        netbox_vm = VirtualMachine.objects.filter(cluster__name=cluster_name, name=vm_name).first()
+    snapshot = proxmox_vm.cluster.nb_snapshot
+    if snapshot is not None:
+        netbox_vm = snapshot.get_netbox_vm(vmid, node, vm_name)
+    else:
+        netbox_vm = VirtualMachine.objects.filter(cluster__name=cluster_name, custom_field_data__proxmox_id=vmid,
+                                                  custom_field_data__proxmox_node=node).first()
+        if netbox_vm is None:
+            netbox_vm = VirtualMachine.objects.filter(cluster__name=cluster_name, name=vm_name).first()
 
     status = 'offline'
     if proxmox_vm.status == 'running':
@@ -685,15 +460,11 @@ def upsert_netbox_vm(proxmox_vm, config=None):
         try:
             netbox_vm = VirtualMachine(name=vm_name)
             netbox_vm.save()
-            print("VIRTUAL MACHINE CREATED")
-            print(netbox_vm)
+            logger.debug("Virtual machine created: %s", netbox_vm)
 
         except Exception as e:
-            print("Error: get_set_vm - {}".format(e))
-            print("[get_set_vm] Creation of VM/CT failed.")
-            # logger.exception(e)
-            # traceback.print_exc()
-            print(e)
+            logger.error("Error: get_set_vm - Creation of VM/CT failed - %s", e)
+            report_failure('get_set_vm')
             netbox_vm = None
 
     if netbox_vm:
@@ -711,9 +482,10 @@ def upsert_netbox_vm(proxmox_vm, config=None):
         # Update all the machine resources if necesary
         netbox_vm = base_resources(netbox_vm, proxmox_vm)
         # Add the tags
-        c_tag = tag()
-        netbox_vm.tags.add(c_tag)
-        netbox_vm = base_tag(netbox_vm)
+        current_tag_ids = snapshot.get_tag_ids(netbox_vm) if snapshot is not None else None
+        netbox_vm, tag_ids = base_tag(netbox_vm, current_tag_ids=current_tag_ids)
+        if snapshot is not None:
+            snapshot.set_tag_ids(netbox_vm, tag_ids)
 
         # Update tenat base on the configuration of the vm
         netbox_vm = base_add_configuration(netbox_vm, proxmox_vm, config)
@@ -722,67 +494,102 @@ def upsert_netbox_vm(proxmox_vm, config=None):
         # Add ipv4 and ipv6 if found
         netbox_vm = base_add_ip(netbox_vm, proxmox_vm, config)
         netbox_vm.save()
+        if snapshot is not None:
+            snapshot.add_netbox_vm(netbox_vm)
 
     return netbox_vm
 
 
-async def async_get_total_count_by_job(job_id):
-    return await asyncio.to_thread(get_total_count_by_job, job_id)
-
-
-def get_total_count_by_job(job_id):
+def get_stale_vm_query(job_id, domain=None, excluded_domains=None, selection=None):
+    """
+    Query of the ids of the vms not seen by the job and its parameters. Every branch filters npv.domain with = or
+    is null next to npv.latest_job, so it is answered with proxmoxvm_domain_job_idx
+    domain: only the vms of the domain, the cleanup at the end of the pipeline of the domain
+    excluded_domains: without domain, the vms of every domain except these ones plus the vms without domain
+    selection: SyncSelection of the cleanup, only its nodes and vmids are taken
+    """
+    if domain is not None:
+        branches = [("npv.domain = %s", [domain])]
+    else:
+        branches = [("npv.domain <> all(%s)", [list(excluded_domains or [])]), ("npv.domain is null", [])]
+    selection_conditions = []
+    selection_params = []
+    if selection is not None:
+        if selection.nodes:
+            selection_conditions.append("npv.node = any(%s)")
+            selection_params.append(list(selection.nodes))
+        if selection.vmids:
+            selection_conditions.append("npv.proxmox_vm_id = any(%s)")
+            selection_params.append(list(selection.vmids))
+
+    queries = []
+    params = []
+    for domain_condition, domain_params in branches:
+        conditions = [domain_condition, "npv.latest_job <> %s"] + selection_conditions
+        queries.append("select virtual_machine_id from netbox_proxbox_proxmoxvm npv where {}".format(
+            ' and '.join(conditions)))
+        params += domain_params + [str(job_id)] + selection_params
+    return ' union all '.join(queries), params
+
+
+async def async_get_total_count_by_job(job_id, domain=None, excluded_domains=None, selection=None):
+    return await asyncio.to_thread(get_total_count_by_job, job_id, domain, excluded_domains, selection)
+
+
+def get_total_count_by_job(job_id, domain=None, excluded_domains=None, selection=None):
     try:
+        stale_query, params = get_stale_vm_query(job_id, domain, excluded_domains, selection)
         with connection.cursor() as cursor:
             query_count = '''
                 select count(*)
 from virtualization_virtualmachine as vv
-where id in (select virtual_machine_id
-             from netbox_proxbox_proxmoxvm npv
-             where npv.latest_job <> %s)
-                '''
-            cursor.execute(query_count, [job_id])
+where id in ({})
+                '''.format(stale_query)
+            cursor.execute(query_count, params)
             results = namedtuplefetchall(cursor)
             count = results[0].count
             # total_pages = math.ceil(count / limit)
             return count
 
     except Exception as e:
-        print("Error: get_total_pages - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
-        return 0
-
-
-async def async_get_vm_to_delete_by_job(job_id, page, limit=100):
-    return await asyncio.to_thread(get_vm_to_delete_by_job, job_id, page, limit)
-
-
-def get_vm_to_delete_by_job(job_id, page, limit=100):
-    try:
-        offset = (page - 1) * limit
-        query_count = '''
-                    select *
-                    from virtualization_virtualmachine as vv
-                    where id in
-                          (select virtual_machine_id
-                           from netbox_proxbox_proxmoxvm npv
-                           where npv.latest_job <> '{}')
-                    limit {} offset {}
-                    '''.format(job_id, limit, offset)
-        print('[{:%H:%M:%S}] query: {}'.format(datetime.now(), query_count))
-        results = VirtualMachine.objects.raw(query_count)
-        output = []
-        for i in results:
-            output.append(i)
-        return output
-
-    except Exception as e:
-        print("Error: get_vm_to_delete - {}".format(e))
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
-        return None
+        # Not a count of 0, the cleanup would take it as nothing to check and report success
+        logger.error("Error: get_total_pages - %s", e)
+        raise e
+
+
+def get_vm_to_delete_after(job_id, last_id=0, limit=100, domain=None, excluded_domains=None, selection=None):
+    """
+    Page of vms not seen by the job using keyset pagination on the id, so deleting rows while paging can't skip
+    any and every page costs the same
+    """
+    stale_query, params = get_stale_vm_query(job_id, domain, excluded_domains, selection)
+    query = '''
+            select vv.*
+            from virtualization_virtualmachine as vv
+            where vv.id > %s
+              and vv.id in ({})
+            order by vv.id
+            limit %s
+            '''.format(stale_query)
+    return list(VirtualMachine.objects.raw(query, [last_id] + params + [limit]))
+
+
+async def async_iter_vm_to_delete_by_job(job_id, limit=100, domain=None, excluded_domains=None, selection=None):
+    last_id = 0
+    while True:
+        try:
+            results = await asyncio.to_thread(get_vm_to_delete_after, job_id, last_id, limit, domain,
+                                              excluded_domains, selection)
+        except Exception as e:
+            # Raised so the cleanup is recorded as failed instead of looking like there was nothing to delete
+            logger.error("Error: async_iter_vm_to_delete_by_job - %s", e)
+            raise e
+        if len(results) < 1:
+            return
+        yield results
+        if len(results) < limit:
+            return
+        last_id = results[-1].id
 
 
 def get_tags_name(vm):
@@ -800,7 +607,7 @@ def full_vm_delete(vm, proxbox_vm):
         from .nb_proxbox import delete_proxbox_vm_sql
         if proxbox_vm:
             try:
-                print('[{:%H:%M:%S}] The latest job was: {}...'.format(timezone.now(), proxbox_vm.latest_job))
+                logger.debug("The latest job of %s was: %s", vm.name, proxbox_vm.latest_job)
                 proxbox_vm.virtual_machine_id = None
                 proxbox_vm.cluster_id = None
                 proxbox_vm.device_id = None
@@ -808,61 +615,56 @@ def full_vm_delete(vm, proxbox_vm):
                 # delete_proxbox_vm_sql(proxbox_vm.id)
                 proxbox_vm.delete()
             except Exception as e:
-                print(f'[ERROR] The proxbox vm/ct')
-                # logger.exception(e)
-                # traceback.print_exc()
-                print(e)
+                logger.error("Error: full_vm_delete - The proxbox vm/ct - %s", e)
         # with transaction.atomic():
         r = vm.delete()  # VirtualMachine.objects.filter(id=vm.id).delete()
-        print(f'[OK] DELETED {vm.name}')
-        print(r)
+        metrics.count_object(proxbox_vm.domain if proxbox_vm else None, 'deleted')
+        logger.info("Deleted vm %s: %s", vm.name, r)
     except Exception as e:
-        print(f'[ERROR] Deleting vm - 1 ')
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: full_vm_delete - Deleting vm %s - %s", vm.name, e)
     finally:
         return vm
 
 
-async def async_delete_vm(vm, job_id):
-    return await asyncio.to_thread(delete_vm, vm, job_id)
+async def async_delete_vm(vm, job_id, seen=None):
+    return await asyncio.to_thread(delete_vm, vm, job_id, seen)
 
 
-def delete_vm(vm, job_id):
+def delete_vm(vm, job_id, seen=None):
+    """
+    seen: optional dict of domain -> set of proxmox ids, the vms that are kept are added to it so the caller can
+    stamp the job in all of them at once instead of saving them one by one
+    """
     # Get the task and the vm from the database
     try:
         if vm:
-            print('[{:%H:%M:%S}] Deleting vm: {}...'.format(timezone.now(), vm.name))
+            logger.debug("Checking vm to delete: %s", vm.name)
             # Get the configuration from the proxbox table
-            from .nb_proxbox import get_proxmox_config, upsert_proxbox_from_vm
-            config, proxbox_vm, domain, node, vmid, type = get_proxmox_config(vm)
+            from .nb_proxbox import get_proxmox_config, upsert_proxbox_from_vm, VM_GONE, VM_FETCH_FAILED
+            config, proxbox_vm, domain, node, vmid, type, status = get_proxmox_config(vm)
             tags_name, tg = get_tags_name(vm)
             if tg.name in tags_name:
-                if config is None:
-                    print('[{:%H:%M:%S}] Executing full Delete for: {}...'.format(timezone.now(), vm.name))
+                if status == VM_FETCH_FAILED:
+                    # Proxmox couldn't be asked, the vm is checked again by the next job
+                    logger.debug("Not deleting the vm: %s proxmox couldn't be asked", vm.name)
+                elif status == VM_GONE:
+                    logger.debug("Executing full delete for: %s", vm.name)
                     full_vm_delete(vm, proxbox_vm)
                 elif proxbox_vm is None:
                     from ..proxmox.proxmox_cluster import ProxmoxCluster
-                    cluster = ProxmoxCluster.instance_cluster(domain).nb_cluster
+                    cluster = ProxmoxCluster.get_or_instance_cluster(domain).nb_cluster
                     proxbox_vm = upsert_proxbox_from_vm(vm, domain, node, vmid, job_id, cluster, type, config)
-                    print(
-                        '[{:%H:%M:%S}] Not deleting the vm: {} proxbox registry created ...'.format(
-                            timezone.now(), vm.name))
+                    logger.debug("Not deleting the vm: %s proxbox registry created", vm.name)
+                elif seen is not None:
+                    seen.setdefault(proxbox_vm.domain, set()).add(proxbox_vm.proxmox_vm_id)
+                    logger.debug("Not deleting the vm: %s configuration and registry found", vm.name)
                 else:
                     proxbox_vm.latest_job = job_id
                     proxbox_vm.latest_update = (datetime.now()).replace(microsecond=0, tzinfo=pytz.utc)
                     proxbox_vm.save()
-                    print(
-                        '[{:%H:%M:%S}] Not deleting the vm: {} configuration and registry found ...'.format(
-                            timezone.now(), vm.name))
+                    logger.debug("Not deleting the vm: %s configuration and registry found", vm.name)
             else:
-                print(
-                    '[{:%H:%M:%S}] Not tag found for the vm: {} ...'.format(
-                        timezone.now(), vm.name))
+                logger.debug("Not tag found for the vm: %s", vm.name)
     except Exception as e:
-        print(f'[ERROR] Deleting vm')
-        # logger.exception(e)
-        # traceback.print_exc()
-        print(e)
+        logger.error("Error: delete_vm - %s", e)
     return vm
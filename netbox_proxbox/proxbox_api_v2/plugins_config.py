@@ -34,6 +34,8 @@ DEFAULT_NETBOX_VM_ROLE_ID = DEFAULT_NETBOX_SETTINGS.get("virtualmachine_role_id"
 DEFAULT_NETBOX_VM_ROLE_NAME = DEFAULT_NETBOX_SETTINGS.get("virtualmachine_role_name", "Proxbox Basic Role")
 DEFAULT_NETBOX_NODE_ROLE_ID = DEFAULT_NETBOX_SETTINGS.get("node_role_id", 0)
 DEFAULT_NETBOX_SITE_ID = DEFAULT_NETBOX_SETTINGS.get("site_id", 0)
+DEFAULT_NETBOX_DB_MAX_CONCURRENCY = DEFAULT_NETBOX_SETTINGS.get("db_max_concurrency", 10)
+DEFAULT_NETBOX_FULL_SYNC_INTERVAL = DEFAULT_NETBOX_SETTINGS.get("full_sync_interval", 60)
 
 NETBOX_SETTING = USER_PLUGINS_CONFIG.get("netbox", DEFAULT_NETBOX_SETTING)
 NETBOX_SETTINGS = NETBOX_SETTING.get("settings", DEFAULT_NETBOX_SETTINGS)
@@ -41,6 +43,8 @@ NETBOX_TENANT_NAME = "proxbox_tenant"
 NETBOX_TENANT_REGEX_VALIDATOR = "proxbox"
 NETBOX_TENANT_DESCRIPTION = "Proxbox custom tenant and tag"
 NETBOX_MANUFACTURER = "Proxbox Basic Manufacturer"
+NETBOX_DB_MAX_CONCURRENCY = DEFAULT_NETBOX_DB_MAX_CONCURRENCY
+NETBOX_FULL_SYNC_INTERVAL = DEFAULT_NETBOX_FULL_SYNC_INTERVAL
 if NETBOX_SETTINGS is not None:
     NETBOX_VM_ROLE_ID = NETBOX_SETTINGS.get("virtualmachine_role_id", DEFAULT_NETBOX_VM_ROLE_ID)
     NETBOX_VM_ROLE_NAME = NETBOX_SETTINGS.get("virtualmachine_role_name", DEFAULT_NETBOX_VM_ROLE_NAME)
@@ -50,5 +54,7 @@ if NETBOX_SETTINGS is not None:
     NETBOX_TENANT_REGEX_VALIDATOR = NETBOX_SETTINGS.get("tenant_regex_validator", NETBOX_TENANT_REGEX_VALIDATOR)
     NETBOX_TENANT_DESCRIPTION = NETBOX_SETTINGS.get("tenant_description", NETBOX_TENANT_DESCRIPTION)
     NETBOX_MANUFACTURER = NETBOX_SETTINGS.get("manufacturer", NETBOX_TENANT_DESCRIPTION)
+    NETBOX_DB_MAX_CONCURRENCY = NETBOX_SETTINGS.get("db_max_concurrency", DEFAULT_NETBOX_DB_MAX_CONCURRENCY)
+    NETBOX_FULL_SYNC_INTERVAL = NETBOX_SETTINGS.get("full_sync_interval", DEFAULT_NETBOX_FULL_SYNC_INTERVAL)
 
 PROXMOX_SESSIONS_LIST, PROXMOX_SESSIONS = ProxboxSession.get_list_from_file(PROXMOX_SETTING_FILE_PATH)
@@ -0,0 +1,60 @@
+'''
+Minimal asyncio client for the Proxmox API with the same navigation as proxmoxer, so the scrapper can write
+    await api.nodes(node).qemu(vmid).config.get()
+instead of running the blocking proxmoxer call in a thread. It needs the optional httpx dependency.
+'''
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class AsyncProxmoxResource:
+
+    def __init__(self, api, path=None):
+        self._api = api
+        self._path = path or []
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return AsyncProxmoxResource(self._api, self._path + [item])
+
+    def __call__(self, resource_id=None):
+        if resource_id is None:
+            return self
+        return AsyncProxmoxResource(self._api, self._path + [str(resource_id)])
+
+    async def get(self, **params):
+        return await self._api.request('GET', self._path, params)
+
+
+class AsyncProxmoxAPI(AsyncProxmoxResource):
+
+    def __init__(self, host, port=8006, user=None, token_name=None, token_value=None, verify_ssl=False, timeout=5,
+                 pool_size=10, retries=3):
+        if httpx is None:
+            raise Exception("The async Proxmox client needs httpx installed")
+        super().__init__(self)
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self._client = httpx.AsyncClient(
+            base_url='https://{}:{}/api2/json'.format(host, port),
+            headers={'Authorization': 'PVEAPIToken={}!{}={}'.format(user, token_name, token_value)},
+            # The requests over the pool limit wait for a free connection instead of failing with PoolTimeout, the
+            # callers are already bounded by the semaphore of the domain
+            timeout=httpx.Timeout(timeout, pool=None),
+            transport=httpx.AsyncHTTPTransport(verify=verify_ssl, limits=limits, retries=retries),
+        )
+
+    async def request(self, method, path, params=None):
+        response = await self._client.request(method, '/' + '/'.join(path), params=params or None)
+        response.raise_for_status()
+        return response.json().get('data')
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    @staticmethod
+    def is_available():
+        return httpx is not None
@@ -1,8 +1,17 @@
+import asyncio
 import json
+import logging
 from django.utils import timezone
 from dataclasses import dataclass, field
 
 from proxmoxer import ProxmoxAPI
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .proxbox_async_client import AsyncProxmoxAPI
+from . import metrics
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -17,6 +26,16 @@ class ProxboxSession:
     site_name: str = 'unknown'
     node_role_name: str = "Hypervisor"
     session: ProxmoxAPI = None
+    # Max number of vms synchronized at the same time for the domain
+    max_concurrency: int = 6
+    # HTTP connection pool to the domain, by default derived from max_concurrency
+    pool_size: int = None
+    timeout: int = 5
+    retries: int = 3
+    backoff_factor: float = 0.3
+    # Use the asyncio client (needs httpx) instead of running proxmoxer in threads
+    async_client: bool = False
+    async_session: AsyncProxmoxAPI = None
 
     # Node creation Values
     manufacturer: str = "Dell",
@@ -39,14 +58,89 @@ class ProxboxSession:
                 user=self.user,
                 token_name=self.token_name,
                 token_value=self.token_value,
-                verify_ssl=self.ssl
+                verify_ssl=self.ssl,
+                timeout=self.timeout
             )
         except Exception as e:
             print(f"Error connecting to the domain {self.domain}")
             print(e)
             self.session = None
+            return self
+        try:
+            self.configure_http_pool()
+        except Exception as e:
+            # The session still works with the default adapters of proxmoxer
+            logger.error("Error: configure_http_pool - %s %s", self.domain, e)
         return self
 
+    def get_pool_size(self):
+        if self.pool_size:
+            return int(self.pool_size)
+        # Every vm worker and node request of the domain can hold a connection at the same time
+        return max(10, int(self.max_concurrency) * 2)
+
+    def configure_http_pool(self):
+        """
+        Replace the default requests adapters of proxmoxer (10 connections) with a pool sized for the concurrency
+        of the domain, the connections are kept alive and reused between the worker threads instead of opening
+        new TLS sessions
+        """
+        http_session = getattr(self.session, '_store', {}).get('session')
+        if http_session is None:
+            return None
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.get_pool_size(),
+            max_retries=retry,
+            # Wait for a free connection instead of opening one that is thrown away afterwards
+            pool_block=True
+        )
+        http_session.mount('https://', adapter)
+        http_session.mount('http://', adapter)
+        return http_session
+
+    def get_async_session(self):
+        if not self.async_client or not AsyncProxmoxAPI.is_available():
+            return None
+        if self.async_session is None:
+            self.async_session = AsyncProxmoxAPI(
+                self.domain,
+                port=self.http_port if self.http_port else 8006,
+                user=self.user,
+                token_name=self.token_name,
+                token_value=self.token_value,
+                verify_ssl=self.ssl,
+                timeout=self.timeout,
+                pool_size=self.get_pool_size(),
+                retries=self.retries
+            )
+        return self.async_session
+
+    async def async_query(self, query, endpoint=None):
+        """
+        Run a query against the domain, query receives the api (proxmoxer or the async client, both navigate the
+        same way) and returns the result of .get(), e.g. lambda api: api.cluster.resources.get(type='vm').
+        endpoint is the label of the request in the latency metrics, e.g. 'cluster/resources'
+        """
+        async_session = self.get_async_session()
+        with metrics.time_proxmox_request(self.domain, endpoint):
+            if async_session is not None:
+                return await query(async_session)
+            return await asyncio.to_thread(query, self.session)
+
+    async def async_close(self):
+        if self.async_session is not None:
+            await self.async_session.aclose()
+            self.async_session = None
+
     @staticmethod
     def instance_from_dict(dictionary: dict):
         domain = dictionary.get("domain", None)
@@ -57,6 +151,12 @@ class ProxboxSession:
         ssl = dictionary.get("ssl", None)
         site_name = dictionary.get("site_name", None)
         node_role_name = dictionary.get("node_role_name", None)
+        max_concurrency = dictionary.get("max_concurrency", None) or 6
+        pool_size = dictionary.get("pool_size", None)
+        timeout = dictionary.get("timeout", None) or 5
+        retries = dictionary.get("retries", 3)
+        backoff_factor = dictionary.get("backoff_factor", 0.3)
+        async_client = dictionary.get("async_client", False)
         manufacturer = dictionary.get("manufacturer", None)
         virtualmachine_role_id = dictionary.get("virtualmachine_role_id", None)
         virtualmachine_role_name = dictionary.get("virtualmachine_role_name", None)
@@ -75,6 +175,12 @@ class ProxboxSession:
             ssl=ssl,
             site_name=site_name,
             node_role_name=node_role_name,
+            max_concurrency=max_concurrency,
+            pool_size=pool_size,
+            timeout=timeout,
+            retries=retries,
+            backoff_factor=backoff_factor,
+            async_client=async_client,
             manufacturer=manufacturer,
             virtualmachine_role_id=virtualmachine_role_id,
             virtualmachine_role_name=virtualmachine_role_name,
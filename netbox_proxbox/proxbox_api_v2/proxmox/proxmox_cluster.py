@@ -1,7 +1,10 @@
 from dataclasses import dataclass, field
 import asyncio
+import threading
 
 from ..netbox_handler.nb_cluster import upsert_cluster
+from ..netbox_handler.nb_snapshot import NetboxSnapshot
+from .proxmox_config import ProxmoxConfigCache
 
 try:
     from virtualization.models import Cluster
@@ -28,6 +31,14 @@ class ProxmoxCluster:
     # nodes: ProxmoxNodes = field(init=False)
     nb_cluster: Cluster = None
     job_id: str = ""
+    # NetBox state of the cluster loaded once per job
+    nb_snapshot: NetboxSnapshot = None
+    # Configuration of the vms fetched once per job
+    config_cache: ProxmoxConfigCache = None
+
+    # domain -> ProxmoxCluster of the current job
+    registry = {}
+    _registry_lock = threading.Lock()
 
     def __post_init__(self):
         if self.proxbox_session is None:
@@ -45,6 +56,17 @@ class ProxmoxCluster:
         if self.proxbox_session is None:
             return
         result = self.proxbox_session.session.cluster.status.get()
+        return self.set_status(result)
+
+    async def async_complete_cluster(self):
+        if self.proxbox_session is None:
+            self.proxbox_session = self.reset_proxbox_session()
+        if self.proxbox_session is None:
+            return
+        result = await self.proxbox_session.async_query(lambda api: api.cluster.status.get(), 'cluster/status')
+        return self.set_status(result)
+
+    def set_status(self, result):
         cluster = result[0]
         self.data = result
         self.name = cluster.get("name", None)
@@ -60,9 +82,27 @@ class ProxmoxCluster:
         self.nb_cluster = upsert_cluster(self)
         return self
 
+    async def async_load_snapshot(self):
+        self.nb_snapshot = await NetboxSnapshot.async_instance_from_cluster(self)
+        return self.nb_snapshot
+
     @staticmethod
     async def async_instance_cluster(domain, proxbox_session=None):
-        return await asyncio.to_thread(ProxmoxCluster.instance_cluster, domain, proxbox_session)
+        if domain is None:
+            raise Exception("Domain can not be null")
+        cluster = ProxmoxCluster(
+            domain=domain,
+            proxbox_session=proxbox_session
+        )
+        if cluster.proxbox_session is None:
+            raise Exception("The cluster wasn't correctly initialize")
+        # Compleate the information for the cluster
+        await cluster.async_complete_cluster()
+        # Upsert the cluster in netbox
+        await cluster.async_add_cluster_to_netbox()
+        ProxmoxCluster.registry[domain] = cluster
+
+        return cluster
 
     @staticmethod
     def instance_cluster(domain, proxbox_session=None):
@@ -78,5 +118,24 @@ class ProxmoxCluster:
         cluster.complete_cluster()
         # Upsert the cluster in netbox
         cluster.add_cluster_to_netbox()
+        ProxmoxCluster.registry[domain] = cluster
+
+        return cluster
 
+    @staticmethod
+    def get_for_domain(domain):
+        return ProxmoxCluster.registry.get(domain)
+
+    @staticmethod
+    def get_or_instance_cluster(domain):
+        """
+        Cluster built earlier in the job, only a domain that wasn't synced by the job is fetched from Proxmox, once
+        """
+        cluster = ProxmoxCluster.get_for_domain(domain)
+        if cluster is not None:
+            return cluster
+        with ProxmoxCluster._registry_lock:
+            cluster = ProxmoxCluster.get_for_domain(domain)
+            if cluster is None:
+                cluster = ProxmoxCluster.instance_cluster(domain)
         return cluster
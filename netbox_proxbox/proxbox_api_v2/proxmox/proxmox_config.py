@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+from ..proxbox_session import ProxboxSession
+from ..plugins_config import PROXMOX_SESSIONS
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProxmoxConfigCache:
+    """
+    Configuration of the vms of a domain fetched once per job, vm by vm, so the upsert and cleanup paths can
+    read it instead of calling proxmox again for every vm
+    """
+    domain: str = None
+    proxbox_session: ProxboxSession = None
+    # (node, vmid) -> configuration
+    configs: dict = field(default_factory=dict)
+    # vmid -> (node, type) of all the vms in cluster/resources, None until the listing is set
+    listing: dict = None
+
+    # domain -> ProxmoxConfigCache of the current job
+    registry = {}
+
+    def __post_init__(self):
+        if self.proxbox_session is None and self.domain is not None:
+            self.proxbox_session = PROXMOX_SESSIONS.get(self.domain)
+
+    @staticmethod
+    def _vmid_key(vmid):
+        return str(vmid) if vmid is not None else None
+
+    @staticmethod
+    def get_config_resource(api, node, vm_type, vmid):
+        if vm_type == 'qemu':
+            return api.nodes(node).qemu(vmid).config
+        if vm_type == 'lxc':
+            return api.nodes(node).lxc(vmid).config
+        return None
+
+    def fetch_config(self, node, vm_type, vmid):
+        if self.proxbox_session is None or self.proxbox_session.session is None:
+            return None
+        resource = self.get_config_resource(self.proxbox_session.session, node, vm_type, vmid)
+        if resource is None:
+            return None
+        with metrics.time_proxmox_request(self.domain, 'nodes/{}/config'.format(vm_type)):
+            return resource.get()
+
+    async def async_fetch_config(self, api, node, vm_type, vmid):
+        resource = ProxmoxConfigCache.get_config_resource(api, node, vm_type, vmid)
+        if resource is None:
+            return None
+        with metrics.time_proxmox_request(self.domain, 'nodes/{}/config'.format(vm_type)):
+            return await resource.get()
+
+    def add(self, node, vmid, config):
+        self.configs[(node, self._vmid_key(vmid))] = config
+        return config
+
+    def has(self, node, vmid):
+        return (node, self._vmid_key(vmid)) in self.configs
+
+    def get(self, node, vmid):
+        return self.configs.get((node, self._vmid_key(vmid)))
+
+    def set_listing(self, proxmox_vms):
+        # Without an answer every vm would look deleted, the cleanup asks proxmox instead
+        if proxmox_vms is None:
+            return self.listing
+        self.listing = {
+            self._vmid_key(vm.get('vmid')): (vm.get('node'), vm.get('type'))
+            for vm in proxmox_vms if vm.get('vmid') is not None
+        }
+        return self.listing
+
+    def has_listing(self):
+        return self.listing is not None
+
+    def locate(self, vmid):
+        """
+        (node, type) of the vm in the cluster/resources listing of the job, None if it isn't in the cluster
+        """
+        if self.listing is None:
+            return None
+        return self.listing.get(self._vmid_key(vmid))
+
+    async def async_fetch_vm(self, node, vm):
+        """
+        Fetch and cache the configuration of a single vm, with the async client if enabled or in a thread with the
+        pooled session of the domain. The caller holds the semaphore of the domain
+        """
+        async_session = self.proxbox_session.get_async_session() if self.proxbox_session is not None else None
+        try:
+            if async_session is not None:
+                config = await self.async_fetch_config(async_session, node, vm.type, vm.vmid)
+            else:
+                config = await asyncio.to_thread(self.fetch_config, node, vm.type, vm.vmid)
+        except Exception as e:
+            logger.error("Error: async_fetch_vm - %s %s/%s", e, node, vm.vmid)
+            # Leave the vm out of the cache so the upsert path tries again
+            return None
+        if config is not None:
+            self.add(node, vm.vmid, config)
+        return config
@@ -1,4 +1,5 @@
 import asyncio
+import logging
 from dataclasses import dataclass, field
 
 from dcim.models import Device
@@ -8,6 +9,8 @@ from ..netbox_handler.nb_nodes import upsert_nodes
 from ..plugins_config import PROXMOX_SESSIONS
 from ..proxbox_session import ProxboxSession
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class ProxmoxNodes:
@@ -56,11 +59,23 @@ class ProxmoxNodes:
         return self
 
     async def async_get_node_network(self):
-        return await asyncio.to_thread(self.get_node_network)
+        logger.debug("Getting Node for %s", self.name)
+        result = await self.proxbox_session.async_query(lambda api: api.nodes(self.name).network().get(),
+                                                        'nodes/network')
+        self.set_node_network(result)
+        return await asyncio.to_thread(self.add_node_to_netbox)
 
     def get_node_network(self):
-        print(f"Getting Node for {self.name}")
+        logger.debug("Getting Node for %s", self.name)
         result = self.proxbox_session.session.nodes(self.name).network().get()
+        self.set_node_network(result)
+        return self.add_node_to_netbox()
+
+    def add_node_to_netbox(self):
+        self.nb_node = upsert_nodes(self)
+        return self
+
+    def set_node_network(self, result):
         for d in result:
             if 'address' in d and d['address'] == self.ip:
                 self.cidr = d['cidr'] if 'cidr' in d else None
@@ -80,7 +95,6 @@ class ProxmoxNodes:
                 self.netmask = d['netmask'] if 'netmask' in d else None
                 self.network_data = d
                 break
-        self.nb_node = upsert_nodes(self)
         return self
 
     @staticmethod
@@ -109,11 +123,24 @@ class ProxmoxNodes:
                 data = ProxmoxNodes.instance_from_object(i, domain, cluster)
                 output.append(data)
             except Exception as e:
-                print(e)
+                logger.error("Error: get_nodes_from_list - %s", e)
                 continue
         return output
         # return [ProxmoxNodes.instance_from_object(i, domain) for i in value]
 
+    @staticmethod
+    def index_nodes(nodes: list):
+        """
+        (cluster_name, node_name) -> ProxmoxNodes, built once so the vms can find their node in constant time
+        """
+        index = {}
+        for node in nodes:
+            if node is None or node.cluster is None:
+                continue
+            # Keep the first node found, the same as the linear search it replaces
+            index.setdefault((node.cluster.name, node.name), node)
+        return index
+
     @staticmethod
     def get_nodes_from_cluster(cluster):
         rawNodes = cluster.data[1:]
@@ -0,0 +1,65 @@
+from dataclasses import dataclass, field
+
+from ..proxbox_session import ProxboxSession
+
+
+@dataclass
+class ProxmoxTaskLog:
+    """
+    Recent tasks of a cluster (cluster/tasks), used by the incremental sync to find the vms that were started,
+    stopped, migrated, created or reconfigured since the previous job
+    """
+    domain: str = None
+    proxbox_session: ProxboxSession = None
+    # start time of the newest task seen by the previous job
+    since: int = None
+    tasks: list = field(default_factory=list)
+
+    @staticmethod
+    def _vmid(task):
+        # The id of the vm tasks is the vmid, the other tasks use an empty id or the name of the storage, node, ...
+        task_id = str(task.get('id') or '')
+        return task_id if task_id.isdigit() else None
+
+    def high_water_mark(self):
+        starttimes = [task.get('starttime') for task in self.tasks if task.get('starttime') is not None]
+        if not starttimes:
+            return self.since
+        return max(max(starttimes), self.since or 0)
+
+    def covers_since(self):
+        """
+        Proxmox only keeps the latest tasks of every node in the log, if the oldest task of a node is newer than the
+        previous high water mark some of its tasks may be missing and the changes can't be trusted. A busy node
+        can lose them while a quiet one still has old tasks, so every node is checked on its own
+        """
+        if self.since is None:
+            return False
+        oldest = {}
+        for task in self.tasks:
+            starttime = task.get('starttime')
+            if starttime is None:
+                continue
+            node = task.get('node')
+            oldest[node] = min(oldest.get(node, starttime), starttime)
+        return all(starttime <= self.since for starttime in oldest.values())
+
+    def changed_vmids(self):
+        vmids = set()
+        for task in self.tasks:
+            vmid = self._vmid(task)
+            if vmid is None:
+                continue
+            starttime = task.get('starttime') or 0
+            endtime = task.get('endtime')
+            # Tasks still running are taken as changes until a job sees them finished
+            if self.since is None or endtime is None or starttime >= self.since or endtime >= self.since:
+                vmids.add(vmid)
+        return vmids
+
+    @staticmethod
+    async def async_from_cluster(cluster, since=None):
+        task_log = ProxmoxTaskLog(domain=cluster.domain, proxbox_session=cluster.proxbox_session, since=since)
+        task_log.tasks = await cluster.proxbox_session.async_query(lambda api: api.cluster.tasks.get(),
+                                                                   'cluster/tasks') or []
+        return task_log
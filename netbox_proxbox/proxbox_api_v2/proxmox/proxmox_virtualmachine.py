@@ -1,19 +1,29 @@
 import asyncio
-import math
+import logging
 from django.utils import timezone
 from dataclasses import dataclass, field
 
 from .proxmox_cluster import ProxmoxCluster
 from .proxmox_node import ProxmoxNodes
-from ..netbox_handler.nb_proxbox import upsert_proxbox_item
+from .proxmox_config import ProxmoxConfigCache
+from .proxmox_tasks import ProxmoxTaskLog
+from ..netbox_handler.nb_proxbox import upsert_proxbox_item, mark_proxbox_vms_seen, get_unchanged_proxbox_vm
+from ..netbox_handler.nb_sync_task import get_last_cluster_sync, is_full_sync_due, get_task_hwm, \
+    start_cluster_sync, finish_sync_task, checkpoint
+from ..netbox_handler.nb_ipaddress import reconcile_snapshot_ip_addresses
 from ..proxbox_session import ProxboxSession
+from ..concurrency import get_domain_semaphore, get_netbox_db_semaphore
+from .. import metrics
 from ..plugins_config import (
-    PROXMOX_SESSIONS_LIST, PROXMOX_SESSIONS
+    PROXMOX_SESSIONS_LIST, PROXMOX_SESSIONS, NETBOX_FULL_SYNC_INTERVAL
 )
-from ..netbox_handler.nb_virtualmachine import get_total_count_by_job, get_vm_to_delete_by_job, async_delete_vm, \
-    async_get_total_count_by_job, async_get_vm_to_delete_by_job
+from ..netbox_handler.nb_virtualmachine import async_delete_vm, async_get_total_count_by_job, \
+    async_iter_vm_to_delete_by_job
 
 from ...models import ProxmoxVM
+from ...choices import TaskStatusChoices
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
@@ -56,12 +66,29 @@ class ProxmoxVirtualMachine:
     async def async_add_vm_to_netbox(self):
         return await asyncio.to_thread(self.add_vm_to_netbox)
 
+    async def async_bounded_add_vm_to_netbox(self):
+        # Wait for a free slot in the NetBox database, a slow vm only holds its own slot. The configuration is
+        # already in the cache of the cluster so proxmox is not called here
+        async with get_netbox_db_semaphore():
+            return await self.async_add_vm_to_netbox()
+
+    @staticmethod
+    async def async_sync_node(cluster, node_name, vms):
+        # Every vm fetches its own configuration under the semaphore of the domain and is written to NetBox as
+        # soon as it arrives, a slow configuration only delays its own vm
+        async def sync_vm(vm):
+            async with get_domain_semaphore(cluster.proxbox_session):
+                await cluster.config_cache.async_fetch_vm(node_name, vm)
+            return await vm.async_bounded_add_vm_to_netbox()
+
+        return await asyncio.gather(*[sync_vm(vm) for vm in vms], return_exceptions=True)
+
     def add_vm_to_netbox(self):
         try:
-            self.nb_vm = upsert_proxbox_item(self)
+            with metrics.count_vm_queries(self.domain):
+                self.nb_vm = upsert_proxbox_item(self)
         except Exception as e:
-            print(f"Error with the vm {self.name} at {self.domain}")
-            print(e)
+            logger.error("Error with the vm %s at %s - %s", self.name, self.domain, e)
             raise e
         return self
 
@@ -97,30 +124,124 @@ class ProxmoxVirtualMachine:
         )
 
     @staticmethod
-    async def async_get_vms_from_cluster(cluster, nodes):
-        runner = []
-        vm_totals = []
-        proxmox_vms = cluster.proxbox_session.session.cluster.resources.get(type='vm')
+    async def async_get_sync_mode(cluster, incremental=False):
+        """
+        Decide if the domain gets a full or an incremental sync, the task log is read in both cases so the job
+        records the high water mark the next incremental job starts from
+        """
+        previous_sync = await asyncio.to_thread(get_last_cluster_sync, cluster.domain)
+        full_sync = True
+        if incremental:
+            full_sync = await asyncio.to_thread(is_full_sync_due, cluster.domain, NETBOX_FULL_SYNC_INTERVAL)
+        task_log = None
+        try:
+            task_log = await ProxmoxTaskLog.async_from_cluster(cluster, get_task_hwm(previous_sync))
+        except Exception as e:
+            logger.error("Error: async_get_sync_mode - %s %s", cluster.domain, e)
+        if task_log is None or not task_log.covers_since():
+            full_sync = True
+        return full_sync, task_log
+
+    @staticmethod
+    async def async_get_vms_from_cluster(cluster, node_index, incremental=False, parent_task=None, selection=None):
+        """
+        Sync the vms of the cluster and remove the stale vms of its domain. The cleanup is part of the sync task of
+        the domain, a job resumed after an interruption in the cleanup runs it again
+        """
+        full_sync, task_log = await ProxmoxVirtualMachine.async_get_sync_mode(cluster, incremental)
+        partial = selection is not None and selection.is_partial()
+        sync_task = await asyncio.to_thread(start_cluster_sync, cluster.domain, cluster.job_id, full_sync, parent_task,
+                                            partial)
+        try:
+            with metrics.time_stage('vms', cluster.domain):
+                vms = await ProxmoxVirtualMachine.async_sync_cluster_vms(cluster, node_index, full_sync, task_log,
+                                                                        sync_task, selection)
+            with metrics.time_stage('cleanup', cluster.domain):
+                await ProxmoxVirtualMachine.async_clear_vms(str(cluster.job_id), sync_task=sync_task,
+                                                            domain=cluster.domain, selection=selection)
+        except Exception as e:
+            await asyncio.to_thread(finish_sync_task, sync_task, TaskStatusChoices.STATUS_FAILED, e)
+            raise e
+
+        snapshot = cluster.nb_snapshot
+        await asyncio.to_thread(
+            finish_sync_task, sync_task,
+            task_hwm=task_log.high_water_mark() if task_log is not None else None,
+            vms=len(snapshot.seen_vmids),
+            synced=len(vms)
+        )
+        return vms
+
+    @staticmethod
+    async def async_sync_cluster_vms(cluster, node_index, full_sync=True, task_log=None, sync_task=None,
+                                     selection=None):
+        vms_by_node = {}
+        job_id = str(cluster.job_id)
+        # Don't block the event loop, the other clusters keep running meanwhile
+        proxmox_vms = await cluster.proxbox_session.async_query(lambda api: api.cluster.resources.get(type='vm'),
+                                                                'cluster/resources')
+        # Load the NetBox state of the cluster once instead of querying it for every vm
+        await cluster.async_load_snapshot()
+        snapshot = cluster.nb_snapshot
+        cluster.config_cache = ProxmoxConfigCache.instance_for_domain(cluster.domain, cluster.proxbox_session)
+        # The cleanup checks the vms against the listing instead of asking proxmox for every one of them
+        cluster.config_cache.set_listing(proxmox_vms)
+        changed_vmids = task_log.changed_vmids() if task_log is not None else set()
         for vm in proxmox_vms:
             is_template = vm.get("template")
             if is_template == 1:
                 continue
-            node = next(iter([x for x in nodes if x.name == vm.get('node') and x.cluster.name == cluster.name]), None)
+            if selection is not None and not selection.match_vmid(vm.get('vmid')):
+                continue
+            # Only the selected nodes are in the index
+            node = node_index.get((cluster.name, vm.get('node')))
             if node is None:
                 continue
             vm['domain'] = cluster.domain
             vm_value = ProxmoxVirtualMachine.instance_from_object(vm, cluster, node)
-            # await vm_value.async_add_vm_to_netbox()
-            runner.append(vm_value.async_add_vm_to_netbox())
-            if len(runner) > 5:
-                r1 = await asyncio.gather(*runner, return_exceptions=True)
-                vm_totals = vm_totals + r1
-                runner = []
-                await asyncio.sleep(0)
-
-        results = await asyncio.gather(*runner, return_exceptions=True)
-        if len(results) > 0:
-            vm_totals = vm_totals + results
+            # A resumed job skips the vms it already wrote before it was interrupted, the fingerprint is only stored
+            # once their ip addresses were applied too
+            proxbox_vm = snapshot.get_proxbox_vm(vm_value.vmid, vm_value.name)
+            if proxbox_vm is not None and proxbox_vm.virtual_machine_id is not None \
+                    and proxbox_vm.latest_job == job_id and proxbox_vm.fingerprint is not None:
+                snapshot.seen_vmids.add(vm_value.vmid)
+                continue
+            if not full_sync and str(vm_value.vmid) not in changed_vmids:
+                # No task for the vm since the previous job and the same resources, its configuration is not
+                # fetched again and only the job is stamped
+                proxbox_vm = get_unchanged_proxbox_vm(vm_value)
+                if proxbox_vm is not None:
+                    snapshot.seen_vmids.add(vm_value.vmid)
+                    snapshot.unchanged_proxbox_ids.append(proxbox_vm.id)
+                    metrics.count_object(cluster.domain, 'unchanged')
+                    continue
+            vms_by_node.setdefault(node.name, []).append(vm_value)
+
+        total = sum(len(node_vms) for node_vms in vms_by_node.values())
+        done = 0
+
+        async def sync_node(node_name, node_vms):
+            nonlocal done
+            results = await ProxmoxVirtualMachine.async_sync_node(cluster, node_name, node_vms)
+            # Checkpoint the progress of the domain every time a node finishes
+            done += len(node_vms)
+            await asyncio.to_thread(checkpoint, sync_task, done, total, '{}/{} vms'.format(done, total))
+            return results
+
+        runner = [sync_node(node_name, node_vms) for node_name, node_vms in vms_by_node.items()]
+        vm_totals = []
+        for r in await asyncio.gather(*runner, return_exceptions=True):
+            if isinstance(r, Exception):
+                continue
+            vm_totals = vm_totals + r
+
+        # Apply the ip addresses of all the upserted vms in one batch
+        async with get_netbox_db_semaphore():
+            await asyncio.to_thread(reconcile_snapshot_ip_addresses, snapshot)
+        # Stamp the job in all the vms seen in the cluster with a single query
+        await asyncio.to_thread(mark_proxbox_vms_seen, cluster.domain, snapshot.seen_vmids, cluster.job_id)
+        logger.info("%s vms seen, %s unchanged in %s (%s sync)", len(snapshot.seen_vmids),
+                    len(snapshot.unchanged_proxbox_ids), cluster.domain, 'full' if full_sync else 'incremental')
 
         vms = []
         for r in vm_totals:
@@ -131,47 +252,47 @@ class ProxmoxVirtualMachine:
         return vms
 
     @staticmethod
-    async def async_clear_vms(job_id):
-        print('[{:%H:%M:%S}] Starting cleaning vms job {}...'.format(timezone.now(), job_id))
+    async def async_clear_vms(job_id, limit=100, max_concurrency=10, sync_task=None, domain=None,
+                              excluded_domains=None, selection=None):
+        """
+        Delete the vms of the domain not seen by the job. Without domain the vms of every domain except
+        excluded_domains are checked, the final pass of the job for the domains no longer configured. With a
+        selection only its nodes and vmids are checked. Raises if the stale vms can't be read, so the caller records
+        the cleanup as failed
+        """
+        logger.info("Starting cleaning vms job %s %s", job_id, domain or '')
         output = []
-        # Get all the vm's to be deleted
-        limit = 100
-        count = await async_get_total_count_by_job(job_id)
-        print('[{:%H:%M:%S}] Cleaning {} jobs...'.format(timezone.now(), count))
+        count = await async_get_total_count_by_job(job_id, domain, excluded_domains, selection)
+        logger.info("Checking %s vms not seen by the job", count)
         # if there are no task just finish the process
         if count < 1:
-            return
+            return output
 
-        runner = []
-        pages = math.ceil(count / limit)
-        print('[{:%H:%M:%S}] Total pages: {}'.format(timezone.now(), pages))
-        for n in range(pages):
-            # Get the vms to be deleted
-            print('[{:%H:%M:%S}] Getting the list of VMs...'.format(timezone.now()))
-            try:
-                results = await async_get_vm_to_delete_by_job(job_id, n + 1, limit)
-                print('[{:%H:%M:%S}] Got for this page {}'.format(timezone.now(), len(results)))
-                if results is None or len(results) < 1:
+        # Vms that are kept, stamped per domain with a single query at the end
+        seen = {}
+        checked = 0
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def bounded_delete_vm(vm):
+            # The local semaphore keeps one cleanup from taking every slot, the shared one keeps the cleanups and
+            # the upserts of all the domains within netbox.settings.db_max_concurrency
+            async with semaphore:
+                async with get_netbox_db_semaphore():
+                    return await async_delete_vm(vm, job_id, seen)
+
+        # Stream the vms to be deleted page by page
+        async for results in async_iter_vm_to_delete_by_job(job_id, limit, domain, excluded_domains, selection):
+            logger.debug("Got for this page %s", len(results))
+            res_vms = await asyncio.gather(*[bounded_delete_vm(vm) for vm in results], return_exceptions=True)
+            for r in res_vms:
+                if isinstance(r, Exception):
                     continue
+                output.append(r)
+            checked += len(results)
+            await asyncio.to_thread(checkpoint, sync_task, checked, count, 'cleaning {}/{} vms'.format(checked, count))
 
-                for vm in results:
-                    runner.append(async_delete_vm(vm, job_id))
-                    # print('[{:%H:%M:%S}] Deleting VM...{}'.format(timezone.now(), vm))
-                    # try:
-                    #     r = await async_delete_vm(vm, job_id)
-                    #     if isinstance(r, Exception):
-                    #         continue
-                    #     print('[{:%H:%M:%S}] Adding to output...{}'.format(timezone.now(), r))
-                    #     output.append(r)
-                    # except Exception as e1:
-                    #     print(e1)
-
-            except Exception as e:
-                print(e)
-
-        res_vms = await asyncio.gather(*runner, return_exceptions=True)
-        for r in res_vms:
-            if isinstance(r, Exception):
-                continue
-            output.append(r)
+        for seen_domain, vmids in seen.items():
+            await asyncio.to_thread(mark_proxbox_vms_seen, seen_domain, vmids, job_id)
+        logger.info("Cleaning of job %s %s finished: %s vms checked, %s kept", job_id, domain or '', checked,
+                    sum(len(vmids) for vmids in seen.values()))
         return output
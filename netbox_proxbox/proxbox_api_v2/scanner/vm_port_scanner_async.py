@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import resource
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from .vm_port_scanner_queue import VMPortScannerQueue, mapped_ports
+
+logger = logging.getLogger(__name__)
+
+# Ports probed before the scan to measure the round trip time of every host, an open port answers with a SYN-ACK and
+# a closed one with a RST, both give the round trip time. Only a filtered port doesn't answer
+PROBE_PORTS = [22, 80, 443, 3389, 1]
+
+# File descriptors left for the database, the log and the rest of the process when capping the sockets in flight
+RESERVED_FILE_DESCRIPTORS = 128
+
+# Result of a connection that failed without an answer from the host (too many open files, no buffer space, ...),
+# the port may be open or closed
+INCONCLUSIVE = 'inconclusive'
+
+
+@dataclass
+class HostState:
+    """
+    Connection limit, rate and timeout of a single host. The timeout is rtt_multiplier times the connect time
+    measured on the ports that answered (open or refused), so a LAN host doesn't keep a worker waiting the full
+    timeout on every filtered port. Until a port answered the timeout is max_timeout
+    """
+    host: str
+    timeout: float = 3
+    min_timeout: float = 0.2
+    max_timeout: float = 3
+    rtt_multiplier: float = 4
+    # Smoothed round trip time, None until a port answered
+    srtt: float = None
+    semaphore: asyncio.Semaphore = None
+    # New connections per second, None for no limit
+    rate: float = None
+    _next_connect: float = 0
+
+    async def wait_turn(self):
+        if not self.rate:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self._next_connect)
+        self._next_connect = start + 1 / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def observe(self, rtt):
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        self.timeout = min(self.max_timeout, max(self.min_timeout, self.rtt_multiplier * self.srtt))
+
+    def retry_timeout(self, attempt):
+        return min(self.max_timeout, self.timeout * 2 ** attempt)
+
+
+@dataclass
+class VMPortScannerAsync(VMPortScannerQueue):
+    """
+    Port scanner on non blocking sockets in a single event loop instead of a thread per socket. A fixed number of
+    workers takes the (vm, ip, port) items, so the number of connections in flight never exceeds max_in_flight and
+    the connections to the same host never exceed per_host_limit, opened at most per_host_rate per second.
+    max_in_flight is capped by the open files limit of the process, a socket that can't be opened is not a closed
+    port
+    """
+    max_in_flight: int = 2000
+    per_host_limit: int = 200
+    per_host_rate: float = None
+    timeout: float = 3
+    min_timeout: float = 0.2
+    rtt_multiplier: float = 4
+    # Retries of the ports without answer, with twice the timeout every time
+    retries: int = 1
+    # Retries of the connections that failed without an answer, see INCONCLUSIVE
+    error_retries: int = 3
+    probe_ports: List[int] = field(default_factory=(lambda: list(PROBE_PORTS)))
+    _hosts: Dict[str, HostState] = field(default_factory=dict)
+    _open_ports: list = field(default_factory=list)
+    # vm id -> ports whose result was inconclusive, their services are kept
+    _inconclusive_ports: Dict[int, set] = field(default_factory=dict)
+
+    def cap_max_in_flight(self):
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit == resource.RLIM_INFINITY:
+            return self.max_in_flight
+        limit = max(1, soft_limit - RESERVED_FILE_DESCRIPTORS)
+        if self.max_in_flight > limit:
+            logger.warning("Capping the connections in flight from %s to %s, the open files limit is %s",
+                           self.max_in_flight, limit, soft_limit)
+            self.max_in_flight = limit
+        return self.max_in_flight
+
+    def get_host_state(self, host):
+        host_state = self._hosts.get(host)
+        if host_state is None:
+            host_state = HostState(
+                host=host,
+                timeout=self.timeout,
+                min_timeout=self.min_timeout,
+                max_timeout=self.timeout,
+                rtt_multiplier=self.rtt_multiplier,
+                semaphore=asyncio.Semaphore(self.per_host_limit),
+                rate=self.per_host_rate
+            )
+            self._hosts[host] = host_state
+        return host_state
+
+    @staticmethod
+    async def async_test_port_number(host_state, port, timeout=None):
+        """
+        True if the port is open, False if it is closed, None if there was no answer before the timeout and
+        INCONCLUSIVE if the connection failed on this side (too many open files, no buffer space, ...)
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host_state.host, port),
+                                                    timeout or host_state.timeout)
+        except asyncio.TimeoutError:
+            return None
+        except ConnectionRefusedError:
+            host_state.observe(loop.time() - start)
+            return False
+        except OSError as e:
+            logger.debug("> %s:%s inconclusive - %s", host_state.host, port, e)
+            return INCONCLUSIVE
+        host_state.observe(loop.time() - start)
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+    @staticmethod
+    def get_port_map(port):
+        port_type = 'tcp'
+        port_map = mapped_ports.get(f'{port}/tcp')
+        if port_map is None:
+            port_map = mapped_ports.get(f'{port}/udp')
+            port_type = 'udp'
+        if port_map is None:
+            port_type = 'tcp'
+            port_map = {'description': 'Unknown', 'name': f'{port}'}
+        return port_type, port_map
+
+    async def async_process_port(self, vm, ip, port):
+        host = str(ip.address.ip)
+        host_state = self.get_host_state(host)
+        async with host_state.semaphore:
+            await host_state.wait_turn()
+            is_open = await self.async_test_port_number(host_state, port)
+            # No answer may be a filtered port or a lost packet, only those are tried again
+            attempt = 0
+            while is_open is None and attempt < self.retries:
+                attempt += 1
+                await host_state.wait_turn()
+                is_open = await self.async_test_port_number(host_state, port, host_state.retry_timeout(attempt))
+            # A connection that failed on this side is tried again once the other sockets had time to close
+            attempt = 0
+            while is_open == INCONCLUSIVE and attempt < self.error_retries:
+                attempt += 1
+                await asyncio.sleep(0.5 * attempt)
+                await host_state.wait_turn()
+                is_open = await self.async_test_port_number(host_state, port)
+        if is_open == INCONCLUSIVE:
+            logger.warning("> %s:%s inconclusive, its services are kept", host, port)
+            self._inconclusive_ports.setdefault(vm.id, set()).add(port)
+            return None
+        if not is_open:
+            return None
+        port_type, port_map = self.get_port_map(port)
+        logger.debug("> %s:%s [OPEN] -> %s: %s", host, port, port_map.get("name"), port_map.get("description"))
+        value = (port, port_type, port_map, host, vm, ip)
+        self._open_ports.append(value)
+        return value
+
+    def iter_items(self):
+        # Port by port over all the ips, so consecutive connections go to different hosts
+        for port in self._ports:
+            for vm, ip in self._ip_list:
+                yield vm, ip, port
+
+    async def async_probe_hosts(self):
+        """
+        Measure the round trip time of every host on the probe ports, all of them with the maximum timeout, so the
+        scan starts with the timeout of every host
+        """
+        hosts = list({str(ip.address.ip) for vm, ip in self._ip_list})
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def probe(host_state, port):
+            async with semaphore:
+                await host_state.wait_turn()
+                await self.async_test_port_number(host_state, port, self.timeout)
+
+        probes = []
+        for host in hosts:
+            host_state = self.get_host_state(host)
+            for port in self.probe_ports + self.initial_ports:
+                probes.append(probe(host_state, port))
+        await asyncio.gather(*probes, return_exceptions=True)
+
+        measured = [self._hosts[host] for host in hosts if self._hosts[host].srtt is not None]
+        logger.info("Measured the round trip time of %s of %s ips", len(measured), len(hosts))
+        for host_state in measured:
+            logger.debug("> %s rtt %.4f timeout %.4f", host_state.host, host_state.srtt, host_state.timeout)
+
+    async def async_scan(self):
+        items = self.iter_items()
+
+        async def worker():
+            for vm, ip, port in items:
+                try:
+                    await self.async_process_port(vm, ip, port)
+                except Exception as e:
+                    logger.error("Error: async_scan - %s:%s - %s", ip, port, e)
+                    self._inconclusive_ports.setdefault(vm.id, set()).add(port)
+
+        workers = min(self.max_in_flight, max(1, len(self._ports) * len(self._ip_list)))
+        await asyncio.gather(*[worker() for _ in range(workers)])
+
+    def load_targets(self):
+        # Get the virtual machines to be process
+        self._netbox_vms = self.get_vm_by_tenant()
+        # Define the ips for the virtual machines to be process
+        for vm in self._netbox_vms:
+            self._process_vm(vm)
+        # define the ports to analise
+        self.define_ports()
+
+    def clear_vm_ports(self):
+        logger.info("Clearing services of %s vms", len(self._netbox_vms))
+        for value in self._services:
+            vm, ip, service = value
+            vm.services.add(service)
+            vm.save()
+
+        for nb_vm in self._netbox_vms:
+            vm_services = [service for vm, ip, service in self._services if vm.id == nb_vm.id]
+            keep_ports = self._inconclusive_ports.get(nb_vm.id, set())
+            logger.debug("Removing closed ports for %s - %s, keeping %s", nb_vm, vm_services, sorted(keep_ports))
+            self.remove_services_from_vm(nb_vm, vm_services, keep_ports)
+
+    def save_services(self):
+        for value in self._open_ports:
+            try:
+                self._services.append(self.set_service_to_vm(value))
+            except Exception as e:
+                logger.error("Error: save_services - %s", e)
+        self.clear_vm_ports()
+
+    async def async_run(self):
+        start_time = time.time()
+        self.cap_max_in_flight()
+        # The ORM can't be used from the event loop
+        await asyncio.to_thread(self.load_targets)
+        await self.async_probe_hosts()
+        logger.info("Scanning %s ports of %s ips", len(self._ports), len(self._ip_list))
+        await self.async_scan()
+        await asyncio.to_thread(self.save_services)
+        logger.info("Port scan of %s vms and %s ips finished: %s open ports, %s inconclusive in %s seconds",
+                    len(self._netbox_vms), len(self._ip_list), len(self._services),
+                    sum(len(ports) for ports in self._inconclusive_ports.values()), int(time.time() - start_time))
+
+    def run(self):
+        asyncio.run(self.async_run())
@@ -1,3 +1,4 @@
+import logging
 import math
 import time
 import os
@@ -25,6 +26,8 @@ if file_contents is None:
 
 mapped_ports = json.loads(file_contents)
 
+logger = logging.getLogger(__name__)
+
 
 @dataclass
 class VMPortScannerQueue:
@@ -94,7 +97,7 @@ class VMPortScannerQueue:
     @staticmethod
     def set_service_to_vm(value):
         port, port_type, port_map, host, vm, ip = value
-        print(f'Processing service {vm} - {ip} - {port}')
+        logger.debug("Processing service %s - %s - %s", vm, ip, port)
         service = Service.objects.filter(virtual_machine_id=vm.id, ports__contains=[port],
                                          ipaddresses=ip.id, protocol=port_type).first()
         if service is None:
@@ -111,18 +114,18 @@ class VMPortScannerQueue:
         service.name = port_map.get("name")
         service.description = f'> {host}:{port} [OPEN] -> {port_map.get("name")}: {port_map.get("description")}'
         service.save()
-        print(f'Service:{service} - {port} saved ...')
+        logger.debug("Service: %s - %s saved", service, port)
         return vm, ip, service
 
     def _process_service_queue(self):
-        print("Running queue")
+        logger.debug("Running queue")
         while self._run_service_queue:
             if self._open_port_to_process is None or len(self._open_port_to_process) < 1:
                 if self._drain_service_queue:
                     self._run_service_queue = False
                     break
                 if (self._tracker_print_waiting % 40) == 0:
-                    print('Waiting for services ...')
+                    logger.debug("Waiting for services ...")
                 self._tracker_print_waiting = (self._tracker_print_waiting + 1) % 40
                 time.sleep(0.1)
                 continue
@@ -147,13 +150,13 @@ class VMPortScannerQueue:
         return ips
 
     def _process_vm(self, vm):
-        print(f'Start processing {vm}')
+        logger.debug("Start processing %s", vm)
         ips = self.get_ips_for_vm(vm)
         if ips is None or len(ips) < 1:
             return vm
         for ip in ips:
             self._ip_list.append((vm, ip))
-        print(f'Finish processing {vm}')
+        logger.debug("Finish processing %s", vm)
         return self._ip_list
 
     def add_port_to_process_service(self, value):
@@ -175,8 +178,7 @@ class VMPortScannerQueue:
             if port_map is None:
                 port_type = 'tcp'
                 port_map = {'description': 'Unknown', 'name': f'{port}'}
-            message = f'> {host}:{port} [OPEN] -> {port_map.get("name")}: {port_map.get("description")}'
-            print(message)
+            logger.debug("> %s:%s [OPEN] -> %s: %s", host, port, port_map.get("name"), port_map.get("description"))
             value = (port, port_type, port_map, host, vm, ip)
             self.add_port_to_process_service(value)
             return value
@@ -195,7 +197,7 @@ class VMPortScannerQueue:
             l_offset = page * self._port_thread_max_size
             r_offset = ((page + 1) * self._port_thread_max_size)
             subset = consolidated_list[l_offset:r_offset]
-            print(f'\n\nProcessing subset: {l_offset}:{r_offset}\n\n')
+            logger.debug("Processing subset: %s:%s", l_offset, r_offset)
             executor = ThreadPoolExecutor(max_workers=len(subset))
             futures = [executor.submit(self.process_port, value) for value in subset]
 
@@ -205,13 +207,17 @@ class VMPortScannerQueue:
         return True
 
     @staticmethod
-    def remove_services_from_vm(vm, services):
+    def remove_services_from_vm(vm, services, keep_ports=None):
+        """
+        Delete the services of the vm that aren't in services, except the ones on keep_ports
+        """
         nb_services = vm.services.all()
         to_remove = []
         output = []
+        keep_ports = keep_ports or set()
 
         for nbs in nb_services:
-            is_to_delete = True
+            is_to_delete = not keep_ports.intersection(nbs.ports or [])
             for s in services:
                 if s.id == nbs.id:
                     is_to_delete = False
@@ -221,14 +227,14 @@ class VMPortScannerQueue:
             else:
                 output.append(nbs)
         for d in to_remove:
-            print(f'Clearing service {d}')
+            logger.debug("Clearing service %s", d)
             vm.services.remove(d)
             d.delete()
 
         return output
 
     def clear_vm_ports(self):
-        print("Clearing Services ...")
+        logger.info("Clearing services of %s vms", len(self._netbox_vms))
         for value in self._services:
             vm, ip, service = value
             vm.services.add(service)
@@ -240,7 +246,7 @@ class VMPortScannerQueue:
                 vm, ip, service = s
                 if vm.id == nb_vm.id:
                     vm_services.append(service)
-            print(f'Removing closed ports for {vm} - {vm_services}')
+            logger.debug("Removing closed ports for %s - %s", nb_vm, vm_services)
             self.remove_services_from_vm(nb_vm, vm_services)
 
     def run(self):
@@ -259,11 +265,12 @@ class VMPortScannerQueue:
             l_offset = page * self._max_parallel_ports
             r_offset = ((page + 1) * self._max_parallel_ports)
             ports_subset = self._ports[l_offset:r_offset]
-            print(f'\n\nPORTS {l_offset}:{r_offset}\n\n')
+            logger.info("Ports %s:%s of %s", l_offset, r_offset, len(self._ports))
             self.process_ip_ports(ports_subset)
 
         self._drain_service_queue = True
         result = self._service_queue_thread.result()
-        print(result)
+        logger.debug(result)
         self.clear_vm_ports()
-        print("---Total run time %s seconds ---" % (time.time() - start_time))
+        logger.info("Port scan of %s vms and %s ips finished: %s open ports in %s seconds", len(self._netbox_vms),
+                    len(self._ip_list), len(self._services), int(time.time() - start_time))
@@ -6,52 +6,70 @@ Execution Steps
 4. Get the nodes for the cluster
 5. For each node get the quemu/lxc machines
 6. For Each machine get the resource information
-7. Remove the unused machines
+7. Remove the unused machines of the domain
+
+Steps 2 to 7 run as an independent pipeline for every domain. Once all of them finished a final pass removes the
+vms of the domains no longer configured
+
+With incremental=True step 6 is only done for the vms with a Proxmox task since the previous job or whose resources
+changed, every netbox.settings.full_sync_interval minutes a domain gets a full sync
+
+The progress is checkpointed in SyncTask, a job interrupted before it finished can be run again with resume=<job id>,
+it skips the domains that finished and the vms already written by the job. The resumed job keeps the incremental
+mode and the selection it was started with
+
+With workers=N the domains are split between N processes (see workers.py), every worker cleans its own domains
+and the final pass runs in this process
 '''
 
 import asyncio
+import logging
+import multiprocessing
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 
 from .plugins_config import PROXMOX_SESSIONS_LIST
+from .concurrency import configure_default_executor
+from .netbox_handler import nb_cache
+from . import metrics
+from .netbox_handler.nb_sync_task import start_job, get_job, get_completed_domains, checkpoint, start_cleanup, \
+    finish_cleanup, is_cleanup_finished, finish_sync_task
 from .proxmox.proxmox_cluster import ProxmoxCluster
+from .proxmox.proxmox_config import ProxmoxConfigCache
 from .proxmox.proxmox_node import ProxmoxNodes
+from .selection import SyncSelection
 
 from django.utils import timezone
 
+from ..choices import TaskStatusChoices
+
 from .proxmox.proxmox_virtualmachine import ProxmoxVirtualMachine
+from .workers import partition_domains, init_worker, sync_domains
+
+logger = logging.getLogger(__name__)
 
 
 class Scrapper:
 
     @staticmethod
-    async def get_all_clusters(job_id=None):
+    async def get_cluster(domain, job_id=None):
         if job_id is None:
             job_id = uuid.uuid4()
-        runner = []
-        clusters = []
-        # Get all the cluster from the configuration
-        for session in PROXMOX_SESSIONS_LIST:
-            cluster = ProxmoxCluster.async_instance_cluster(session.domain)
-            runner.append(cluster)
-        results = await asyncio.gather(*runner, return_exceptions=True)
-
-        # Get all clusters that didn't fail
-        for cluster in results:
-            if isinstance(cluster, Exception):
-                continue
-            cluster.job_id = job_id
-            clusters.append(cluster)
-        return clusters
+        cluster = await ProxmoxCluster.async_instance_cluster(domain)
+        cluster.job_id = job_id
+        return cluster
 
     @staticmethod
-    async def get_all_nodes(clusters):
+    async def get_all_nodes(clusters, selection=None):
         nodes = []
         node_runner = []
         for cluster in clusters:
             if isinstance(cluster, Exception):
                 continue
-            nodes = ProxmoxNodes.get_nodes_from_cluster(cluster)
-            for node in nodes:
+            for node in ProxmoxNodes.get_nodes_from_cluster(cluster):
+                # The vms of the nodes left out aren't synced either, they are looked up in the nodes found
+                if selection is not None and not selection.match_node(node.name):
+                    continue
                 # Get all the network data for the cluster
                 node_runner.append(node.async_get_node_network())
 
@@ -65,67 +83,225 @@ class Scrapper:
         return nodes
 
     @staticmethod
-    async def get_all_vms(clusters, nodes):
-        vms = []
-        runner = []
-        for c in clusters:
-            runner.append(ProxmoxVirtualMachine.async_get_vms_from_cluster(c, nodes))
+    async def sync_cluster(domain, job_id, queue, incremental=False, job_task=None, selection=None):
+        """
+        Pipeline of a single domain: cluster -> nodes -> vms -> cleanup, the outcome is put in the queue as soon as it
+        finishes so one slow or unreachable cluster doesn't delay the others. A cluster left out by the selection
+        is put without cluster nor error
+        """
+        try:
+            logger.info("Getting cluster %s for job %s", domain, job_id)
+            with metrics.time_stage('cluster', domain):
+                cluster = await Scrapper.get_cluster(domain, job_id)
+            if selection is not None and not selection.match_cluster(cluster.name):
+                await queue.put((domain, None, None, None))
+                return
 
-        results = await asyncio.gather(*runner, return_exceptions=True)
+            logger.info("Getting nodes of %s for job %s", domain, job_id)
+            with metrics.time_stage('nodes', domain):
+                nodes = await Scrapper.get_all_nodes([cluster], selection)
+                node_index = ProxmoxNodes.index_nodes(nodes)
 
-        for r in results:
-            if isinstance(r, Exception):
-                continue
-            vms = vms + r
+            logger.info("Setting vms of %s for job %s", domain, job_id)
+            vms = await ProxmoxVirtualMachine.async_get_vms_from_cluster(cluster, node_index, incremental, job_task,
+                                                                         selection)
+            await queue.put((domain, cluster, vms, None))
+        except Exception as e:
+            await queue.put((domain, None, None, e))
 
-        return vms
+    @staticmethod
+    async def sync_all_clusters(job_id, incremental=False, job_task=None, skip_domains=None, domains=None,
+                                progress=True, selection=None):
+        """
+        Sync the domains (the selected ones by default) except skip_domains (finished by a previous run of the
+        same job), returns the synced clusters and the domains that failed. progress=False leaves the progress of
+        the job to the caller, used by the worker processes that only sync a part of the domains
+        """
+        skip_domains = skip_domains or set()
+        queue = asyncio.Queue()
+        if domains is None:
+            domains = Scrapper.get_domains(selection)
+        domains = [domain for domain in domains if domain not in skip_domains]
+        producers = [
+            asyncio.create_task(Scrapper.sync_cluster(domain, job_id, queue, incremental, job_task, selection))
+            for domain in domains
+        ]
+
+        # Consume the clusters in the order they finish
+        clusters = []
+        failed_domains = []
+        total = len(domains) + len(skip_domains)
+        for finished, _ in enumerate(producers, start=len(skip_domains) + 1):
+            domain, cluster, vms, error = await queue.get()
+            if error is not None:
+                logger.error("Cluster %s failed for job %s: %s", domain, job_id, error)
+                failed_domains.append(domain)
+            elif cluster is None:
+                logger.info("Cluster of %s not selected for job %s", domain, job_id)
+            else:
+                logger.info("Cluster %s finished with %s vms for job %s", domain, len(vms), job_id)
+                clusters.append(cluster)
+            if progress:
+                await asyncio.to_thread(checkpoint, job_task, finished, total,
+                                        '{}/{} domains'.format(finished, total))
+
+        await asyncio.gather(*producers, return_exceptions=True)
+        return clusters, failed_domains
+
+    @staticmethod
+    def get_domains(selection=None):
+        return [session.domain for session in PROXMOX_SESSIONS_LIST
+                if selection is None or selection.match_domain(session.domain)]
+
+    @staticmethod
+    async def async_sync_domains(job_id, domains, incremental=False, selection=None):
+        """
+        Sync part of the domains of a job in a worker process, the job was started by the parent process
+        """
+        configure_default_executor()
+        nb_cache.clear()
+        ProxmoxCluster.registry.clear()
+        ProxmoxConfigCache.registry.clear()
+        job_task = await asyncio.to_thread(get_job, job_id)
+        try:
+            clusters, failed_domains = await Scrapper.sync_all_clusters(job_id, incremental, job_task,
+                                                                        domains=domains, progress=False,
+                                                                        selection=selection)
+        finally:
+            for session in PROXMOX_SESSIONS_LIST:
+                await session.async_close()
+        # Every domain cleaned its own vms, only the outcome goes back to the parent process
+        synced = {cluster.domain: len(cluster.nb_snapshot.seen_vmids) if cluster.nb_snapshot is not None else 0
+                  for cluster in clusters}
+        return {'synced': synced, 'failed': failed_domains}
+
+    @staticmethod
+    async def sync_with_workers(job_id, incremental=False, job_task=None, skip_domains=None, workers=2,
+                                selection=None):
+        """
+        Sync the domains in worker processes, returns the synced domains and the domains that failed
+        """
+        skip_domains = skip_domains or set()
+        domains = [domain for domain in Scrapper.get_domains(selection) if domain not in skip_domains]
+        partitions = partition_domains(domains, workers)
+        logger.info("Syncing %s domains in %s worker processes for job %s", len(domains), len(partitions), job_id)
+
+        synced_domains = []
+        failed_domains = []
+        if not partitions:
+            return synced_domains, failed_domains
+
+        loop = asyncio.get_running_loop()
+        executor = ProcessPoolExecutor(
+            max_workers=len(partitions),
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(logging.getLogger('netbox_proxbox').getEffectiveLevel(),)
+        )
+
+        async def run_partition(partition):
+            try:
+                report = await loop.run_in_executor(executor, sync_domains, str(job_id), partition, incremental,
+                                                    selection)
+                return partition, report, None
+            except Exception as e:
+                return partition, None, e
+
+        total = len(domains) + len(skip_domains)
+        finished = len(skip_domains)
+        try:
+            for future in asyncio.as_completed([run_partition(partition) for partition in partitions]):
+                partition, report, error = await future
+                if error is not None:
+                    # The worker died, none of its domains can be trusted
+                    logger.error("Worker of %s failed for job %s: %s", ', '.join(partition), job_id, error)
+                    failed_domains.extend(partition)
+                else:
+                    for domain, vms in report['synced'].items():
+                        logger.info("Domain %s synced by a worker with %s vms for job %s", domain, vms, job_id)
+                        synced_domains.append(domain)
+                    failed_domains.extend(report['failed'])
+                finished += len(partition)
+                await asyncio.to_thread(checkpoint, job_task, finished, total,
+                                        '{}/{} domains'.format(finished, total))
+        finally:
+            executor.shutdown(wait=True)
+        return synced_domains, failed_domains
 
     @staticmethod
-    async def async_run():
-        job_id = uuid.uuid4()
-        message_init = '[{:%H:%M:%S}] Initializing run for job {}...'.format(timezone.now(), job_id)
-        print(message_init)
-        # get all the clusters
-        g_message = '[{:%H:%M:%S}] Getting clusters for job {}...'.format(timezone.now(), job_id)
-        print(g_message)
-        print('=============================================')
-        clusters = await Scrapper.get_all_clusters(job_id)
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-
-        # Get the nodes from the clusters
-        g_message = '[{:%H:%M:%S}] Getting nodes for job {}...'.format(timezone.now(), job_id)
-        print(g_message)
-        nodes = await Scrapper.get_all_nodes(clusters)
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-
-        g_message = '[{:%H:%M:%S}] Setting vms for job {}...'.format(timezone.now(), job_id)
-        print(g_message)
-        await Scrapper.get_all_vms(clusters, nodes)
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-
-        g_message = '[{:%H:%M:%S}] Cleaning vms for job {}...'.format(timezone.now(), job_id)
-        print(g_message)
-        await ProxmoxVirtualMachine.async_clear_vms(str(job_id))
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print('=============================================')
-        print(message_init)
-
-        print('[{:%H:%M:%S}] Finish run for job {}...'.format(timezone.now(), job_id))
+    async def async_run(incremental=False, resume=None, workers=1, selection=None):
+        job_id = resume if resume is not None else uuid.uuid4()
+        configure_default_executor()
+        # Reference data, clusters and vm configurations are only cached for the duration of a job
+        nb_cache.clear()
+        ProxmoxCluster.registry.clear()
+        ProxmoxConfigCache.registry.clear()
+        start_time = timezone.now()
+        if resume is not None:
+            # A resumed job runs with the options it was started with, not the ones given to resume it
+            previous_job = await asyncio.to_thread(get_job, resume)
+            if previous_job is None:
+                raise Exception(f"Job {resume} not found, it can't be resumed")
+            data_instance = previous_job.data_instance or {}
+            incremental = data_instance.get('incremental', False)
+            selection = SyncSelection.from_dict(data_instance.get('selection'))
+        logger.info("Initializing run for job %s, incremental: %s, selection: %s", job_id, incremental,
+                    selection.describe() if selection is not None else 'all')
+        job_task = await asyncio.to_thread(start_job, job_id, incremental=incremental, workers=workers,
+                                           selection=selection.to_dict() if selection is not None else None)
+        skip_domains = set()
+        if resume is not None:
+            skip_domains = await asyncio.to_thread(get_completed_domains, job_id)
+            logger.info("Resuming job %s, skipping the finished domains %s", job_id,
+                        ', '.join(sorted(skip_domains)) or '-')
+        if workers and workers > 1:
+            synced_domains, failed_domains = await Scrapper.sync_with_workers(job_id, incremental, job_task,
+                                                                              skip_domains, workers, selection)
+        else:
+            clusters, failed_domains = await Scrapper.sync_all_clusters(job_id, incremental, job_task,
+                                                                        skip_domains, selection=selection)
+            synced_domains = [cluster.domain for cluster in clusters]
+
+        # Every configured domain cleaned its vms at the end of its pipeline, a domain that failed to sync kept
+        # them. The final pass only takes the vms of the domains no longer configured, a job limited by a selection
+        # leaves them alone
+        cleanup_error = None
+        if selection is not None:
+            logger.info("Skipping the vms of the domains not configured for job %s, limited to %s", job_id,
+                        selection.describe())
+        elif is_cleanup_finished(job_task):
+            logger.info("Vms already cleaned for job %s", job_id)
+        else:
+            configured_domains = [session.domain for session in PROXMOX_SESSIONS_LIST]
+            logger.info("Cleaning the vms of the domains not configured for job %s", job_id)
+            await asyncio.to_thread(start_cleanup, job_task)
+            try:
+                with metrics.time_stage('cleanup'):
+                    await ProxmoxVirtualMachine.async_clear_vms(str(job_id), sync_task=job_task,
+                                                                excluded_domains=configured_domains)
+                await asyncio.to_thread(finish_cleanup, job_task)
+            except Exception as e:
+                # The cleanup stays unfinished, resuming the job runs it again
+                logger.error("Cleaning of job %s failed: %s", job_id, e)
+                cleanup_error = e
+        for session in PROXMOX_SESSIONS_LIST:
+            await session.async_close()
+
+        if failed_domains or cleanup_error is not None:
+            reasons = []
+            if failed_domains:
+                reasons.append('Failed domains: {}'.format(', '.join(failed_domains)))
+            if cleanup_error is not None:
+                reasons.append('Failed cleanup: {}'.format(cleanup_error))
+            await asyncio.to_thread(finish_sync_task, job_task, TaskStatusChoices.STATUS_FAILED, '. '.join(reasons),
+                                    failed_domains=failed_domains)
+        else:
+            await asyncio.to_thread(finish_sync_task, job_task)
+            metrics.set_job_success()
+        logger.info("Finish run for job %s: %s domains synced, %s skipped, %s failed in %s seconds", job_id,
+                    len(synced_domains), len(skip_domains), len(failed_domains),
+                    int((timezone.now() - start_time).total_seconds()))
+        return job_id
 
     @staticmethod
     def run():
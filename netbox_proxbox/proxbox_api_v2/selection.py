@@ -0,0 +1,65 @@
+from dataclasses import dataclass, asdict
+from typing import List
+
+
+@dataclass(frozen=True)
+class SyncSelection:
+    """
+    Part of the configured domains synced by a job (proxboxscrapper --domain/--cluster/--node/--vmid), None is
+    everything. The cleanup of the job is limited to the same part, so the vms outside of it are never taken as
+    stale
+    """
+    domains: List[str] = None
+    clusters: List[str] = None
+    nodes: List[str] = None
+    vmids: List[int] = None
+
+    @staticmethod
+    def from_options(domains=None, clusters=None, nodes=None, vmids=None):
+        selection = SyncSelection(
+            domains=list(domains) if domains else None,
+            clusters=list(clusters) if clusters else None,
+            nodes=list(nodes) if nodes else None,
+            vmids=[int(vmid) for vmid in vmids] if vmids else None,
+        )
+        return None if selection.is_empty() else selection
+
+    @staticmethod
+    def from_dict(data):
+        """
+        Selection stored in the job by to_dict, None is everything
+        """
+        return SyncSelection.from_options(**data) if data else None
+
+    def to_dict(self):
+        return asdict(self)
+
+    def is_empty(self):
+        return not (self.domains or self.clusters or self.nodes or self.vmids)
+
+    def is_partial(self):
+        """
+        True if only some of the vms of a domain are synced, such a sync can't be taken as the last full or
+        incremental sync of the domain
+        """
+        return bool(self.nodes or self.vmids)
+
+    def match_domain(self, domain):
+        return self.domains is None or domain in self.domains
+
+    def match_cluster(self, cluster_name):
+        return self.clusters is None or cluster_name in self.clusters
+
+    def match_node(self, node_name):
+        return self.nodes is None or node_name in self.nodes
+
+    def match_vmid(self, vmid):
+        return self.vmids is None or (vmid is not None and int(vmid) in self.vmids)
+
+    def describe(self):
+        parts = []
+        for name in ('domains', 'clusters', 'nodes', 'vmids'):
+            values = getattr(self, name)
+            if values:
+                parts.append('{}={}'.format(name, ','.join(str(value) for value in values)))
+        return ' '.join(parts) or 'all'
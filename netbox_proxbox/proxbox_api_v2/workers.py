@@ -0,0 +1,42 @@
+'''
+Worker processes of the scrapper (proxboxscrapper --workers N).
+
+The domains are split between the workers, every worker is a new process (spawn) that calls django.setup(), so it
+has its own database connection and Proxmox sessions, and syncs and cleans its domains with
+Scrapper.async_sync_domains. The parent process keeps the job: it checkpoints the progress as the workers finish,
+gathers their reports and runs the final cleanup of the domains no longer configured.
+
+Nothing that needs Django is imported at module level, the module is imported by the new process before
+django.setup() runs.
+'''
+import asyncio
+import logging
+
+
+def partition_domains(domains, workers):
+    """
+    Split the domains round robin in at most workers non empty lists
+    """
+    workers = max(1, int(workers))
+    return [domains[i::workers] for i in range(workers) if domains[i::workers]]
+
+
+def init_worker(log_level=logging.INFO):
+    import django
+    django.setup()
+
+    from .logs import configure_logging
+    configure_logging(log_level)
+
+
+def sync_domains(job_id, domains, incremental=False, selection=None):
+    """
+    Entry point of a worker, returns the report of its domains:
+        {"synced": {domain: number of vms seen}, "failed": [domain, ...]}
+    """
+    from .scrapper import Scrapper
+    try:
+        return asyncio.run(Scrapper.async_sync_domains(job_id, domains, incremental, selection))
+    finally:
+        from .logs import stop_logging
+        stop_logging()
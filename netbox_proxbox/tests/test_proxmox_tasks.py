@@ -0,0 +1,32 @@
+from django.test import SimpleTestCase
+
+from netbox_proxbox.proxbox_api_v2.proxmox.proxmox_tasks import ProxmoxTaskLog
+
+
+def task(node, vmid, starttime):
+    return {'node': node, 'id': str(vmid), 'type': 'qmstart', 'starttime': starttime, 'endtime': starttime + 5}
+
+
+class ProxmoxTaskLogCoversSinceTest(SimpleTestCase):
+
+    def test_without_previous_job(self):
+        self.assertFalse(ProxmoxTaskLog(since=None, tasks=[task('pve1', 100, 900)]).covers_since())
+
+    def test_empty_log(self):
+        self.assertTrue(ProxmoxTaskLog(since=1000, tasks=[]).covers_since())
+
+    def test_every_node_covered(self):
+        task_log = ProxmoxTaskLog(since=1000, tasks=[
+            task('pve1', 100, 900), task('pve1', 101, 1500),
+            task('pve2', 200, 1000), task('pve2', 201, 1200),
+        ])
+        self.assertTrue(task_log.covers_since())
+
+    def test_one_node_truncated(self):
+        # pve2 is busy, its log only goes back to 1200 and the tasks between 1000 and 1200 were dropped, the old
+        # task of the quiet pve1 must not hide it
+        task_log = ProxmoxTaskLog(since=1000, tasks=[
+            task('pve1', 100, 500), task('pve1', 101, 1500),
+            task('pve2', 200, 1200), task('pve2', 201, 1300),
+        ])
+        self.assertFalse(task_log.covers_since())
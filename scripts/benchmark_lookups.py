@@ -0,0 +1,186 @@
+'''
+Micro benchmark of the vm node lookup and of the vm description parser, the old code paths against the current ones,
+with synthetic data so it runs without any Proxmox domain.
+
+    node lookup   linear search of the node list for every vm  vs  ProxmoxNodes.index_nodes + dict lookup
+    description   regex compiled on every call, one parser per field  vs  nb_description.parse_description
+
+It imports the plugin, run it with the NetBox settings:
+
+    $ cd /opt/netbox/netbox
+    $ DJANGO_SETTINGS_MODULE=netbox.settings /opt/netbox/venv/bin/python /path/to/scripts/benchmark_lookups.py
+'''
+import argparse
+import random
+import re
+import timeit
+from types import SimpleNamespace
+
+import django
+
+django.setup()
+
+from netbox_proxbox.proxbox_api_v2.proxmox.proxmox_node import ProxmoxNodes  # noqa: E402
+from netbox_proxbox.proxbox_api_v2.netbox_handler.nb_description import parse_description  # noqa: E402
+
+#
+# Code paths replaced by ProxmoxNodes.index_nodes and parse_description, kept as they were
+#
+ipv4_regex = r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}(\/\d{1,3})?"
+ipv6_regex = r"([a-zA-Z0-9]{1,4}(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?" \
+             r"(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?" \
+             r"(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?(:[a-zA-Z0-9]{0,4})?:([a-zA-Z0-9]{0,4})?" \
+             r":([a-zA-Z0-9]{0,4})?(\.\d{1,3}\.\d{1,3}\.\d{1,3})?(\/\d{1,3})?)"
+
+
+def old_find_node(nodes, cluster, vm):
+    return next(iter([x for x in nodes if x.name == vm.get('node') and x.cluster.name == cluster.name]), None)
+
+
+def old_client_tenant_parser(test_str):
+    client = None
+    tenant_name = None
+    try:
+        it = re.finditer(r"client(\s)?(:)?.*(id)?:", test_str, re.MULTILINE | re.IGNORECASE).__next__()
+        client = it.group()
+        for label in ('client:', 'client :', 'Client:', 'Client :', 'id:', 'id :', '(id :', '(ID:', 'Id:', 'Id :',
+                      '(Id :', '(ID :'):
+            client = client.replace(label, '')
+        client = client.strip()
+        m_result = None
+        try:
+            m_result = re.finditer(r"\(.*\)", client, re.MULTILINE | re.IGNORECASE).__next__().group().strip()
+        except Exception:
+            pass
+        if m_result:
+            if m_result.replace('(', '').replace(')', '').strip():
+                tenant_name = m_result.replace('(', '').replace(')', '').strip()
+            client = client.replace(m_result, '').strip()
+        else:
+            tenant_name = client
+    except Exception:
+        pass
+    return tenant_name, client
+
+
+def old_contact_email(test_str):
+    try:
+        it = re.finditer(r"email(\s)?(:)?(\s)?\w+([\.-]?\w+)*@\w+([\.-]?\w+)*(\.\w{2,3})+", test_str,
+                         re.MULTILINE | re.IGNORECASE).__next__()
+        email = it.group()
+        for label in ('email:', 'email :', 'Email:', 'Email :'):
+            email = email.replace(label, '')
+        return email.strip()
+    except Exception:
+        return None
+
+
+def old_get_main_ip(test_str):
+    ips = []
+    for ip_regex in (ipv4_regex, ipv6_regex):
+        ip = None
+        for rgx in (r"main(\s)?ip:(\s)?", r"ip(\s)?address(\s)?allocation:(\s)?"):
+            try:
+                it = re.finditer(rgx + ip_regex, test_str, re.MULTILINE | re.IGNORECASE).__next__()
+                ip = re.sub(rgx, '', it.group().lower()).strip()
+                break
+            except Exception:
+                pass
+        ips.append(ip)
+    return tuple(ips)
+
+
+def old_parse(description):
+    # The tenant, contact and ip steps of the upsert parsed the description on their own
+    return old_client_tenant_parser(description), old_contact_email(description), old_get_main_ip(description)
+
+
+def new_parse(description):
+    # The same three steps, the description is parsed by the first one and taken from the cache by the others
+    parsed = parse_description(description)
+    parse_description(description)
+    parse_description(description)
+    return parsed
+
+
+#
+# Synthetic data
+#
+def make_nodes(clusters, nodes_per_cluster):
+    nodes = []
+    for c in range(clusters):
+        cluster = SimpleNamespace(name='cluster-{}'.format(c))
+        for n in range(nodes_per_cluster):
+            nodes.append(SimpleNamespace(name='pve{:02d}-n{}'.format(c, n), cluster=cluster))
+    return nodes
+
+
+def make_vms(nodes, vms):
+    return [(node.cluster, {'vmid': 100 + i, 'node': node.name})
+            for i, node in enumerate(random.choice(nodes) for _ in range(vms))]
+
+
+def make_descriptions(count):
+    descriptions = []
+    for i in range(count):
+        lines = [
+            'Client: ACME {} (e1-acme{}) id: {}'.format(i, i, 1000 + i),
+            'Email: ops{}@acme{}.com'.format(i, i % 50),
+            'Main IP: 10.{}.{}.{}/24'.format(i % 250, (i // 250) % 250, i % 200 + 1),
+        ]
+        if i % 2:
+            lines.append('IP address allocation: 2001:db8:{:x}::{:x}/64'.format(i % 65535, i % 4000 + 1))
+        descriptions.append('\n'.join(lines + ['Some notes about the vm {}'.format(i)] * (i % 4)))
+    return descriptions
+
+
+def report(name, old_seconds, new_seconds):
+    print('{:<14} old {:>10.2f} ms   new {:>10.2f} ms   x{:.1f}'.format(
+        name, old_seconds * 1000, new_seconds * 1000, old_seconds / new_seconds if new_seconds else float('inf')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--nodes', type=int, default=16, help="nodes per cluster")
+    parser.add_argument('--vms', type=int, default=5000)
+    parser.add_argument('--descriptions', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    random.seed(0)
+
+    nodes = make_nodes(args.clusters, args.nodes)
+    vms = make_vms(nodes, args.vms)
+
+    def old_nodes():
+        return [old_find_node(nodes, cluster, vm) for cluster, vm in vms]
+
+    def new_nodes():
+        # The index is built once per job, it is part of the measure
+        index = ProxmoxNodes.index_nodes(nodes)
+        return [index.get((cluster.name, vm.get('node'))) for cluster, vm in vms]
+
+    assert old_nodes() == new_nodes()
+    report('node lookup', min(timeit.repeat(old_nodes, number=1, repeat=args.repeat)),
+           min(timeit.repeat(new_nodes, number=1, repeat=args.repeat)))
+
+    descriptions = make_descriptions(args.descriptions)
+
+    def old_descriptions():
+        return [old_parse(description) for description in descriptions]
+
+    def new_descriptions():
+        # Every job runs in a new process with an empty cache, clear it so every run measures the parse
+        parse_description.cache_clear()
+        return [new_parse(description) for description in descriptions]
+
+    for (tenant, email, ips), parsed in zip(old_descriptions(), new_descriptions()):
+        if (tenant, email, ips) != ((parsed.tenant_name, parsed.client), parsed.contact_email,
+                                    (parsed.main_ipv4, parsed.main_ipv6)):
+            print('Different result for the description: {}'.format((tenant, email, ips, parsed)))
+    report('description', min(timeit.repeat(old_descriptions, number=1, repeat=args.repeat)),
+           min(timeit.repeat(new_descriptions, number=1, repeat=args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
@@ -27,6 +27,14 @@ requires = [
     'pytz'
 ]
 
+async_requires = [
+    'httpx>=0.23'
+]
+
+metrics_requires = [
+    'prometheus_client>=0.14'
+]
+
 dev_requires = [
     'pytest>=3.7',
     'check-manifest',
@@ -62,6 +70,8 @@ setup(
     install_requires=requires,
     extras_require={
         "dev": dev_requires,
+        "async": async_requires,
+        "metrics": metrics_requires,
     },
     python_requires= '>=3.7',
 )